@@ -0,0 +1,384 @@
+"""
+Local archive of the raw XML of the harvested records.
+
+With the archive the content of the records can be derived again (e.g.
+after changing the mapping or fixing a reader) without harvesting the
+source again. It is enabled in the CKAN config:
+
+    ckanext.oaipmh.archive = /var/lib/ckan/oaipmh-archive
+    ckanext.oaipmh.archive.segment_size = 64
+
+The records are appended, compressed, to segment files of about
+`segment_size` MB. The index file maps (source id, identifier) to the
+place of the latest version of the record and its datestamp; it is
+append-only as well, the last line of a record wins. Older versions
+are garbage in their segments until compact copies the live records
+of mostly garbage segments to the current segment and removes them.
+
+Segments are read through mmap. Several processes can use the same
+archive, writes and compaction take a lock on the archive.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+from lxml import etree
+
+import listing
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'OAR1'
+# magic, key length, data length
+ENTRY = struct.Struct('>4sHI')
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_NAME = 'segment-%06d'
+SEGMENT_RE = re.compile(r'^segment-(\d{6})$')
+INDEX_NAME = 'index'
+LOCK_NAME = 'lock'
+
+_lock = threading.Lock()
+# (path, pid) -> Archive
+_archives = {}
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_archive(config):
+    """Returns the archive configured in the CKAN config or None.
+
+    The archive is opened once per process (a forked process opens it
+    again, the lock of the archive is per open file).
+    """
+    path = config.get('ckanext.oaipmh.archive')
+    if not path:
+        return None
+    key = (path, os.getpid())
+    with _lock:
+        archive = _archives.get(key)
+        if archive is None:
+            segment_size = int(config.get(
+                'ckanext.oaipmh.archive.segment_size',
+                SEGMENT_SIZE // (1024 * 1024)
+            )) * 1024 * 1024
+            archive = _archives[key] = Archive(path, segment_size)
+    return archive
+
+
+class Archive(object):
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        # (source id, identifier) -> (segment, offset, length, datestamp)
+        self._index = {}
+        self._index_inode = None
+        self._index_offset = 0
+        self._index_writer = None
+        self._segment = None
+        self._segment_writer = None
+        self._maps = {}
+        self._lock = threading.RLock()
+        self._lock_file = open(os.path.join(path, LOCK_NAME), 'a')
+        with self._lock:
+            self._refresh()
+
+    def __len__(self):
+        return len(self._index)
+
+    def put(self, source_id, identifier, datestamp, xml):
+        """Stores the raw XML of a record as its latest version.
+
+        Nothing is written if the archive has the record with the same
+        datestamp already. Returns True if the record was written.
+        """
+        datestamp = _datestamp(datestamp)
+        key = (source_id, identifier)
+        with self._locked():
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is not None and entry[3] == datestamp:
+                return False
+            record_key = u'\n'.join(key + (datestamp,)).encode('utf-8')
+            data = zlib.compress(xml)
+            self._append(
+                key,
+                datestamp,
+                ENTRY.pack(MAGIC, len(record_key), len(data)) +
+                record_key + data
+            )
+            return True
+
+    def get(self, source_id, identifier):
+        """Returns the raw XML of the latest version of the record or
+        None if it is not in the archive
+        """
+        key = (source_id, identifier)
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            try:
+                data = self._read(*entry[:3])
+            except (IOError, OSError):
+                # the segment was compacted by another process
+                self._refresh()
+                entry = self._index.get(key)
+                if entry is None:
+                    return None
+                data = self._read(*entry[:3])
+        segment, offset = entry[:2]
+        magic, key_length, data_length = ENTRY.unpack_from(data)
+        if magic != MAGIC:
+            raise ArchiveError(
+                'No record at %s:%s of %s' % (segment, offset, self.path)
+            )
+        start = ENTRY.size + key_length
+        return zlib.decompress(data[start:start + data_length])
+
+    def records(self, source_id):
+        """Returns the (identifier, datestamp) of the records of the
+        source in the archive
+        """
+        with self._lock:
+            self._refresh()
+            return [
+                (identifier, entry[3])
+                for (source, identifier), entry in self._index.items()
+                if source == source_id
+            ]
+
+    def compact(self, max_garbage=0.5):
+        """Removes the segments (but the current one) of which more
+        than `max_garbage` are older versions of records, after moving
+        their live records to the current segment. Returns the number
+        of removed segments.
+        """
+        with self._locked():
+            self._refresh()
+            segments = self._segments()
+            live = dict((segment, 0) for segment in segments)
+            for segment, _, length, _ in self._index.values():
+                live[segment] = live.get(segment, 0) + length
+            removed = [
+                segment for segment in segments[:-1]
+                if live[segment] < (1 - max_garbage) *
+                os.path.getsize(self._segment_path(segment))
+            ]
+            if not removed:
+                return 0
+
+            # move the records to the last segment, which is kept
+            if self._segment_writer is not None:
+                self._segment_writer.close()
+                self._segment_writer = None
+            for key, (segment, offset, length, datestamp) in \
+                    self._index.items():
+                if segment in removed:
+                    self._append(
+                        key,
+                        datestamp,
+                        self._read(segment, offset, length),
+                        write_index=False
+                    )
+            if self._segment_writer is not None:
+                self._segment_writer.flush()
+            self._write_index()
+            for segment in removed:
+                m = self._maps.pop(segment, None)
+                if m is not None:
+                    m.close()
+                os.remove(self._segment_path(segment))
+            log.info('Compacted %s segments of the archive %s'
+                     % (len(removed), self.path))
+            return len(removed)
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+            for f in (self._index_writer, self._segment_writer):
+                if f is not None:
+                    f.close()
+            self._index_writer = self._segment_writer = None
+
+    @contextmanager
+    def _locked(self):
+        # the thread lock first, the file lock is shared by the threads
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Reads the lines appended to the index (by other processes)
+        since it was read last, or the whole index if it was replaced
+        by compaction
+        """
+        index_path = os.path.join(self.path, INDEX_NAME)
+        try:
+            inode = os.stat(index_path).st_ino
+        except OSError:
+            return
+        if inode != self._index_inode:
+            self._index = {}
+            self._index_inode = inode
+            self._index_offset = 0
+            if self._index_writer is not None:
+                self._index_writer.close()
+                self._index_writer = None
+        with open(index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    # partly written, the writer crashed or is writing
+                    break
+                self._index_offset += len(line)
+                try:
+                    source_id, identifier, segment, offset, length, \
+                        datestamp = json.loads(line)
+                except ValueError:
+                    log.warning('Invalid line in the index of %s: %r'
+                                % (self.path, line))
+                    continue
+                self._index[(source_id, identifier)] = \
+                    (segment, offset, length, datestamp)
+
+    def _append(self, key, datestamp, record, write_index=True):
+        writer = self._writer()
+        writer.seek(0, os.SEEK_END)
+        offset = writer.tell()
+        writer.write(record)
+        entry = (self._segment, offset, len(record), datestamp)
+        if write_index:
+            writer.flush()
+            self._append_index(key, entry)
+        self._index[key] = entry
+
+    def _append_index(self, key, entry):
+        if self._index_writer is None:
+            index_path = os.path.join(self.path, INDEX_NAME)
+            self._index_writer = open(index_path, 'ab')
+            self._index_inode = os.fstat(self._index_writer.fileno()).st_ino
+        if os.fstat(self._index_writer.fileno()).st_size != \
+                self._index_offset:
+            # drop a line left partly written by a crashed writer
+            self._index_writer.truncate(self._index_offset)
+        line = json.dumps(key + entry, separators=(',', ':')) + '\n'
+        self._index_writer.write(line)
+        self._index_writer.flush()
+        self._index_offset += len(line)
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_NAME)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for key, entry in self._index.iteritems():
+                f.write(json.dumps(key + entry, separators=(',', ':')) + '\n')
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, index_path)
+        if self._index_writer is not None:
+            self._index_writer.close()
+            self._index_writer = None
+        self._index_inode = os.stat(index_path).st_ino
+        self._index_offset = size
+
+    def _writer(self):
+        """Returns the file of the current segment, opening a new
+        segment if it is full (or was removed by compaction)
+        """
+        writer = self._segment_writer
+        if writer is not None:
+            stat = os.fstat(writer.fileno())
+            if stat.st_nlink == 0 or stat.st_size >= self.segment_size:
+                writer.close()
+                writer = None
+        if writer is None:
+            segments = self._segments()
+            segment = segments[-1] if segments else 0
+            path = self._segment_path(segment)
+            if os.path.exists(path) and \
+                    os.path.getsize(path) >= self.segment_size:
+                segment += 1
+                path = self._segment_path(segment)
+            writer = self._segment_writer = open(path, 'ab')
+            self._segment = segment
+        return writer
+
+    def _read(self, segment, offset, length):
+        m = self._maps.get(segment)
+        if m is None or offset + length > len(m):
+            if m is not None:
+                m.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+        return m[offset:offset + length]
+
+    def _segments(self):
+        return sorted(
+            int(match.group(1))
+            for match in map(SEGMENT_RE.match, os.listdir(self.path))
+            if match
+        )
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_NAME % segment)
+
+
+def _datestamp(datestamp):
+    if hasattr(datestamp, 'isoformat'):
+        return datestamp.isoformat()
+    return unicode(datestamp)
+
+
+class RawRecordRegistry(object):
+    """Wraps a metadata registry. The metadata it reads keeps the raw
+    XML of its record as `metadata.raw`, to be archived
+    """
+    def __init__(self, registry):
+        self._registry = registry
+
+    def registerReader(self, metadata_prefix, reader):
+        self._registry.registerReader(metadata_prefix, reader)
+
+    def hasReader(self, metadata_prefix):
+        return self._registry.hasReader(metadata_prefix)
+
+    def readMetadata(self, metadata_prefix, element):
+        metadata = self._registry.readMetadata(metadata_prefix, element)
+        record = element.getparent()
+        if record is not None:
+            metadata.raw = etree.tostring(record)
+        return metadata
+
+
+def read_record(xml, registry, metadata_prefix):
+    """Returns the (header, metadata) of the raw XML of an archived
+    record
+    """
+    return listing._build_record(
+        etree.fromstring(xml),
+        listing.NAMESPACES,
+        registry,
+        metadata_prefix
+    )
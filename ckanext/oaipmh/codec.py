@@ -0,0 +1,42 @@
+"""
+Encoding of the content stored in the harvest objects.
+
+The content of a record is a map of field names to values, most of
+them empty lists for DIF. It is stored without the empty lists, as
+zlib compressed JSON behind a version prefix (base64 encoded, as the
+content column is text). Plain JSON content of older versions is
+still read.
+"""
+import base64
+import json
+import zlib
+
+PREFIX = 'z1:'
+
+
+def encode(content_dict):
+    """Returns the encoded content, without the fields which are
+    empty lists. The same content always has the same encoding.
+    """
+    compact = dict(
+        (key, value) for key, value in content_dict.iteritems()
+        if value != []
+    )
+    data = json.dumps(compact, sort_keys=True, separators=(',', ':'))
+    return PREFIX + base64.b64encode(zlib.compress(data))
+
+
+def decode(content, list_fields=()):
+    """Returns the content map of encoded (or plain JSON) content.
+
+    The fields of `list_fields` which are missing get an empty list,
+    so the map has the same fields as the map which was encoded.
+    """
+    if content.startswith(PREFIX):
+        data = zlib.decompress(base64.b64decode(content[len(PREFIX):]))
+        content_dict = json.loads(data)
+    else:
+        content_dict = json.loads(content)
+    for field in list_fields:
+        content_dict.setdefault(field, [])
+    return content_dict
@@ -1,7 +1,213 @@
+import logging
+import multiprocessing
+import time
+
+from ckan import model
 from ckanext.harvest.commands.harvester import Harvester
+from ckanext.harvest.model import HarvestObject
+
+log = logging.getLogger(__name__)
+
+# harvest objects per task of a reimport worker
+REIMPORT_CHUNK_SIZE = 100
 
 
 class OaipmhHarvesterCommand(Harvester):
     """
     OAI-PMH Harvester command
+
+    In addition to the commands of the harvester:
+
+      harvester batch_import {source-id} [--batch-size=N]
+        - re-imports the current harvest objects of the source in batches,
+          with one commit and one search index update per batch
+
+      harvester rederive {source-id} [--batch-size=N]
+        - derives the content of the current harvest objects of the source
+          again from the record archive (without requests to the source)
+          and imports the objects whose content changed
+
+      harvester reimport {source-id} [--workers=N] [--batch-size=N]
+                                     [--from-archive]
+        - re-imports the current harvest objects of the source from their
+          stored content (or, with --from-archive, derives their content
+          again from the record archive first) with N worker processes,
+          without requests to the source
+
+      harvester compact_archive
+        - removes the older versions of the records from the record archive
+    """
+    usage = Harvester.usage + __doc__
+
+    def __init__(self, name):
+        super(OaipmhHarvesterCommand, self).__init__(name)
+        self.parser.add_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=None,
+            help='Number of records imported per commit'
+        )
+        self.parser.add_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes of reimport'
+        )
+        self.parser.add_option(
+            '--from-archive',
+            dest='from_archive',
+            action='store_true',
+            default=False,
+            help='Derive the content from the record archive (reimport)'
+        )
+
+    def command(self):
+        if self.args and self.args[0] == 'batch_import':
+            self._load_config()
+            self.batch_import()
+        elif self.args and self.args[0] == 'rederive':
+            self._load_config()
+            self.rederive()
+        elif self.args and self.args[0] == 'reimport':
+            self._load_config()
+            self.reimport()
+        elif self.args and self.args[0] == 'compact_archive':
+            self._load_config()
+            self.compact_archive()
+        else:
+            super(OaipmhHarvesterCommand, self).command()
+
+    def batch_import(self):
+        from ckanext.oaipmh.harvester import OaipmhHarvester
+
+        if len(self.args) < 2:
+            print 'Please provide a source id'
+            return
+        harvest_objects = self._current_objects(unicode(self.args[1]))
+        imported = OaipmhHarvester().import_objects(
+            harvest_objects,
+            batch_size=self.options.batch_size
+        )
+        print '%s of %s objects imported' % (imported, len(harvest_objects))
+
+    def rederive(self):
+        from ckanext.oaipmh.harvester import OaipmhHarvester
+
+        if len(self.args) < 2:
+            print 'Please provide a source id'
+            return
+        harvest_objects = self._current_objects(unicode(self.args[1]))
+        harvester = OaipmhHarvester()
+        changed = harvester.rederive_objects(harvest_objects)
+        print '%s of %s objects changed' % (len(changed), len(harvest_objects))
+        imported = harvester.import_objects(
+            changed,
+            batch_size=self.options.batch_size
+        )
+        print '%s objects imported' % imported
+
+    def reimport(self):
+        if len(self.args) < 2:
+            print 'Please provide a source id'
+            return
+        # only the ids, the workers load the objects
+        object_ids = [
+            object_id for object_id, in self._current_objects(
+                unicode(self.args[1]),
+                HarvestObject.id
+            )
+        ]
+        chunk_size = self.options.batch_size or REIMPORT_CHUNK_SIZE
+        tasks = [
+            (object_ids[start:start + chunk_size],
+             self.options.from_archive,
+             self.options.batch_size)
+            for start in range(0, len(object_ids), chunk_size)
+        ]
+        # the workers are forked, they must not share the connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        pool = multiprocessing.Pool(
+            max(1, self.options.workers),
+            initializer=_init_reimport_worker
+        )
+        start = time.time()
+        done = imported = failed = 0
+        try:
+            for count, chunk_imported, chunk_failed in \
+                    pool.imap_unordered(_reimport_objects, tasks):
+                done += count
+                imported += chunk_imported
+                failed += chunk_failed
+                print '%s of %s objects, %s imported, %.1f objects/s' % (
+                    done,
+                    len(object_ids),
+                    imported,
+                    done / max(time.time() - start, 1e-9)
+                )
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if failed:
+            print '%s objects were not imported because of errors, ' \
+                'see the log' % failed
+
+    def compact_archive(self):
+        from ckan.plugins import toolkit
+        from ckanext.oaipmh.archive import get_archive
+
+        record_archive = get_archive(toolkit.config)
+        if record_archive is None:
+            print 'No record archive configured (ckanext.oaipmh.archive)'
+            return
+        print '%s segments removed' % record_archive.compact()
+
+    def _current_objects(self, source_id, entity=HarvestObject):
+        return model.Session.query(entity) \
+            .filter(HarvestObject.harvest_source_id == source_id) \
+            .filter(HarvestObject.current.is_(True)) \
+            .filter(HarvestObject.content.isnot(None)) \
+            .order_by(HarvestObject.import_finished) \
+            .all()
+
+
+def _init_reimport_worker():
+    # connections inherited from the parent process must not be used
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _reimport_objects(task):
+    """
+    Re-imports a chunk of harvest objects in a worker process of
+    reimport. Returns the number of objects, of imported objects and
+    of objects which failed altogether.
     """
+    from ckanext.oaipmh.harvester import OaipmhHarvester
+
+    object_ids, from_archive, batch_size = task
+    try:
+        harvest_objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(object_ids)) \
+            .order_by(HarvestObject.import_finished) \
+            .all()
+        harvester = OaipmhHarvester()
+        if from_archive:
+            harvest_objects = harvester.rederive_objects(harvest_objects)
+        imported = harvester.import_objects(
+            harvest_objects,
+            batch_size=batch_size
+        )
+        return len(object_ids), imported, 0
+    except Exception:
+        log.exception('Re-import of %s objects failed' % len(object_ids))
+        model.Session.rollback()
+        return len(object_ids), 0, len(object_ids)
+    finally:
+        model.Session.remove()
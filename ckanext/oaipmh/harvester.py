@@ -1,33 +1,174 @@
 import logging
 import json
-import urllib2
+import datetime
+import hashlib
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import requests
 
 from ckan.model import Session
-from ckan.logic import get_action
+from ckan.logic import get_action, NotFound, ValidationError
 from ckan import model
+from ckan.model.types import make_uuid
+from ckan.lib import search
+from ckan.plugins import toolkit, implements, IConfigurable
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckan.lib.munge import munge_tag
 from ckan.lib.munge import munge_title_to_name
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.harvest.model import HarvestJob, HarvestGatherError
+from ckanext.harvest.model import HarvestObjectError
+from sqlalchemy import exists
 
-import oaipmh.client
+import oaipmh.error
 from oaipmh.metadata import MetadataRegistry
 
+import archive
+import codec
+import listing
+import metrics
+import partition
+import throttle
+import transport
+from cache import LRUCache
 from metadata import oai_ddi_reader
 from metadata import oai_dc_reader
-from metadata import dif_reader, dif_reader2
+from metadata import dif_reader, dif_tree_reader
+from metadata import list_fields
 from pprint import pprint
 
 import traceback
 
 log = logging.getLogger(__name__)
 
+# group name -> group id
+_group_cache = LRUCache(maxsize=1000, ttl=300)
+
+# job id -> settings of the job, dropped when the job is done
+_job_context_cache = LRUCache(maxsize=100, ttl=24 * 60 * 60)
+
+# (harvester class, source id, config hash) -> HarvestProfile
+_profile_cache = LRUCache(maxsize=100)
+
+# number of processes -> process pool of the fetch stage which parses
+# large records, see OaipmhHarvester._get_parse_pool
+_parse_pools = {}
+
+# the source of a record parsed in the process pool
+PoolSource = namedtuple('PoolSource', ['id', 'config'])
+
+# settings of the config of a source, see OaipmhHarvester._get_settings
+HarvestSettings = namedtuple('HarvestSettings', [
+    'credentials',
+    'user',
+    'set_spec',
+    'md_format',
+    'force_http_get',
+    'harvest_mode',
+    'force_all',
+    'incremental_overlap',
+    'gather_retries',
+    'gather_batch_size',
+    'timeout',
+    'pool_size',
+    'max_concurrent_requests',
+    'max_retries',
+    'retry_backoff',
+    'adaptive_concurrency',
+    'fetch_batch_size',
+    # records of at least parse_offload_size bytes are parsed in a
+    # pool of parse_processes processes (with concurrent requests)
+    'parse_processes',
+    'parse_offload_size',
+    'batch_import',
+    'import_batch_size',
+    # 'delete', 'withdraw' or 'ignore'
+    'deleted_records',
+    # None (one listing of the whole repository), 'sets' or 'dates'
+    'gather_partitions',
+    'gather_workers',
+    'date_windows',
+    'max_window_size',
+])
+
+# compiled settings of a source, see OaipmhHarvester._get_profile. The
+# settings of the current profile are set as attributes of the harvester
+# (self.md_format etc.)
+HarvestProfile = namedtuple('HarvestProfile', [
+    'source_id',
+    'settings',
+    'mapping',
+    'mapped_fields',
+    'list_fields',
+    'registry',
+])
+
+
+def _init_parse_worker():
+    # the worker does not use the database. The session and connections
+    # inherited from the parent process are dropped without closing or
+    # rolling them back, which would end the transaction of the parent
+    Session.registry.clear()
+    model.meta.engine.pool = model.meta.engine.pool.recreate()
+
+
+def _parse_in_pool(harvester_class, source, xml):
+    """
+    Returns the content of the record of a GetRecord response, run in
+    a process of the parse pool
+    """
+    harvester = harvester_class()
+    profile = harvester._get_profile(source)
+    header, metadata = listing.parse_record(
+        xml,
+        profile.registry,
+        profile.settings.md_format
+    )
+    return harvester._get_record_content(header, metadata)
+
+
+def _content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+@contextmanager
+def _commits_deferred():
+    """
+    In this block the commits of the session of the current thread
+    (those of _create_or_update_package and of the actions it calls)
+    only flush, the caller commits once for the whole block
+    """
+    session = Session()
+    session.commit = session.flush
+    try:
+        yield
+    finally:
+        del session.commit
+
 
 class OaipmhHarvester(HarvesterBase):
     '''
     OAI-PMH Harvester
     '''
+    implements(IConfigurable)
+
+    # errors of the records of the running import batch
+    _batch_errors = None
+    # names of the groups created for the record being imported in a batch
+    _created_groups = None
+    # the start of an incremental harvest, set by the gather stage
+    from_date = None
+
+    def configure(self, config):
+        # before any stage runs, so that no metrics are dropped
+        metrics.configure(config)
 
     def info(self):
         '''
@@ -56,38 +197,38 @@ class OaipmhHarvester(HarvesterBase):
         '''
         log.debug("in gather stage: %s" % harvest_job.source.url)
         try:
-            harvest_obj_ids = []
-            registry = self._create_metadata_registry()
-            self._set_config(harvest_job.source.config)
-            client = oaipmh.client.Client(
-                harvest_job.source.url,
-                registry,
-                self.credentials,
-                force_http_get=self.force_http_get
+            self._get_profile(harvest_job.source)
+            client = self._get_client(harvest_job.source)
+
+            identify = client.identify()  # check if identify works
+            # pyoai formats the from/until arguments according to
+            # the granularity of the repository
+            client._day_granularity = (
+                identify.granularity() == 'YYYY-MM-DD'
             )
-
-            client.identify()  # check if identify works
-            for header in self._identifier_generator(client):
-                harvest_obj = HarvestObject(
-                    guid=header.identifier(),
-                    job=harvest_job
+            self.from_date = self._get_from_date(harvest_job)
+            if self.from_date:
+                log.info(
+                    'Harvesting records of %s changed since %s'
+                    % (harvest_job.source.url, self.from_date)
                 )
-                harvest_obj.save()
-                harvest_obj_ids.append(harvest_obj.id)
-        except urllib2.HTTPError, e:
+            with metrics.timer('gather', harvest_job.source.id):
+                harvest_obj_ids = self._gather(client, harvest_job, identify)
+        except requests.HTTPError, e:
             log.exception(
                 'Gather stage failed on %s (%s): %s, %s'
                 % (
                     harvest_job.source.url,
-                    e.fp.read(),
-                    e.reason,
-                    e.hdrs
+                    e.response.text,
+                    e.response.reason,
+                    e.response.headers
                 )
             )
             self._save_gather_error(
                 'Could not gather anything from %s' %
                 harvest_job.source.url, harvest_job
             )
+            metrics.count('gather_errors', harvest_job.source.id)
             return None
         except Exception, e:
             log.exception(
@@ -101,33 +242,617 @@ class OaipmhHarvester(HarvesterBase):
                 'Could not gather anything from %s' %
                 harvest_job.source.url, harvest_job
             )
+            metrics.count('gather_errors', harvest_job.source.id)
             return None
+        finally:
+            metrics.flush()
+        metrics.count('gathered', harvest_job.source.id, len(harvest_obj_ids))
         return harvest_obj_ids
 
-    def _identifier_generator(self, client):
+    def _gather(self, client, harvest_job, identify):
+        if self.gather_partitions == 'sets':
+            return self._gather_partitioned(
+                client,
+                harvest_job,
+                self._set_partitions(client)
+            )
+        if self.gather_partitions == 'dates':
+            return self._gather_partitioned(
+                client,
+                harvest_job,
+                self._date_partitions(client, identify),
+                split=partition.date_splitter(
+                    self.max_window_size,
+                    client._day_granularity
+                )
+            )
+        return self._gather_objects(client, harvest_job)
+
+    def _get_from_date(self, harvest_job):
+        """
+        Returns the datestamp from which on records are harvested,
+        based on the start of the last successful job of the source
+        (minus a safety overlap), or None for a full harvest. A job with
+        errors of its records is not successful: the failed records are
+        listed again by the next job.
+        """
+        if self.force_all:
+            return None
+
+        last_job = Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == harvest_job.source_id) \
+            .filter(HarvestJob.id != harvest_job.id) \
+            .filter(HarvestJob.status == u'Finished') \
+            .filter(HarvestJob.gather_started.isnot(None)) \
+            .filter(~exists().where(
+                HarvestGatherError.harvest_job_id == HarvestJob.id)) \
+            .filter(~exists().where(
+                (HarvestObject.harvest_job_id == HarvestJob.id) &
+                (HarvestObjectError.harvest_object_id == HarvestObject.id))) \
+            .order_by(HarvestJob.gather_started.desc()) \
+            .first()
+        if not last_job:
+            return None
+
+        overlap = datetime.timedelta(seconds=self.incremental_overlap)
+        return last_job.gather_started - overlap
+
+    def _list_arguments(self):
         """
         pyoai generates the URL based on the given method parameters
         Therefore one may not use the set parameter if it is not there
         """
+        args = {'metadataPrefix': self.md_format}
         if self.set_spec:
-            for header in client.listIdentifiers(
-                    metadataPrefix=self.md_format,
-                    set=self.set_spec):
-                yield header
+            args['set'] = self.set_spec
+        if self.from_date:
+            args['from_'] = self.from_date
+        return args
+
+    def _gather_objects(self, client, harvest_job):
+        """
+        Creates the HarvestObjects of the job page by page and stores
+        the resumption token of the next page as a checkpoint with
+        the last object of every page.
+
+        If objects were already gathered for the job (e.g. the gather
+        consumer was restarted), the listing continues at the last
+        checkpoint. A failing request is retried from the last
+        checkpoint after a backoff. An expired resumption token
+        restarts the listing from the latest datestamp listed up to the
+        checkpoint (this assumes that the provider lists the records in
+        the order of their datestamps, as most do). Objects are only
+        created once per guid.
+
+        New objects are inserted in batches of `gather_batch_size`
+        with one commit per batch. A checkpoint is committed in the
+        same transaction as the objects of its page. A retry continues
+        at the last committed checkpoint.
+        """
+        harvest_obj_ids, guids, checkpoint = self._get_gather_state(
+            harvest_job
+        )
+        if checkpoint:
+            log.info(
+                'Resuming gather of %s at record %s'
+                % (harvest_job.source.url, checkpoint['cursor'])
+            )
+        retries = self.gather_retries
+        pending = []
+        while True:
+            token = checkpoint['token'] if checkpoint else None
+            try:
+                for page in self._page_generator(client, token):
+                    harvest_obj = self._gather_page(
+                        harvest_job,
+                        page,
+                        harvest_obj_ids,
+                        guids,
+                        pending
+                    )
+                    checkpoint = self._get_checkpoint(checkpoint, page)
+                    if harvest_obj and page.token:
+                        Session.add(HarvestObjectExtra(
+                            object=harvest_obj,
+                            key='gather_checkpoint',
+                            value=json.dumps(checkpoint)
+                        ))
+                self._flush_objects(pending)
+                return harvest_obj_ids
+            except Exception, e:
+                if not checkpoint or not checkpoint['token'] or \
+                        retries <= 0:
+                    raise
+                retries -= 1
+                # continue from the last committed checkpoint, the objects
+                # of later pages are gone (the error can come from a flush)
+                Session.rollback()
+                del pending[:]
+                harvest_obj_ids, guids, checkpoint = self._get_gather_state(
+                    harvest_job
+                )
+                time.sleep(throttle.backoff(
+                    self.retry_backoff,
+                    self.gather_retries - retries - 1,
+                    transport.BACKOFF_MAX
+                ))
+                if isinstance(e, oaipmh.error.BadResumptionTokenError):
+                    if checkpoint and checkpoint.get('datestamp'):
+                        self.from_date = datetime.datetime.strptime(
+                            checkpoint['datestamp'],
+                            '%Y-%m-%dT%H:%M:%S'
+                        )
+                    log.warning(
+                        'Resumption token of %s expired, '
+                        'restarting the listing from %s'
+                        % (harvest_job.source.url, self.from_date)
+                    )
+                    checkpoint = None
+                else:
+                    log.exception(
+                        'Gather of %s failed, resuming at record %s'
+                        % (
+                            harvest_job.source.url,
+                            checkpoint['cursor'] if checkpoint else 0
+                        )
+                    )
+
+    def _set_partitions(self, client):
+        """
+        Returns the list arguments of every set to harvest, the "set"
+        of the config (a set or a list of sets) restricts them
+        """
+        args = self._list_arguments()
+        args.pop('set', None)
+        allowed_sets = self.set_spec or None
+        if isinstance(allowed_sets, basestring):
+            allowed_sets = [allowed_sets]
+        return partition.set_partitions(client, args, allowed_sets)
+
+    def _date_partitions(self, client, identify):
+        """
+        Returns the list arguments of `date_windows` windows from the
+        earliest datestamp of the repository (or the from date of an
+        incremental harvest) until now
+        """
+        return partition.date_partitions(
+            self._list_arguments(),
+            self.from_date or identify.earliestDatestamp(),
+            datetime.datetime.utcnow(),
+            self.date_windows,
+            client._day_granularity
+        )
+
+    def _gather_partitioned(self, client, harvest_job, partitions,
+                            split=None):
+        """
+        Creates the HarvestObjects of the job from the partitions,
+        which are listed by `gather_workers` parallel workers. Records
+        listed in several partitions get only one object.
+
+        Unlike _gather_objects no checkpoints are stored, a restarted
+        gather lists the partitions again but skips the records which
+        were already gathered.
+        """
+        log.info(
+            'Gathering %s partitions of %s with %s workers'
+            % (len(partitions), harvest_job.source.url, self.gather_workers)
+        )
+        harvest_obj_ids, guids, _ = self._get_gather_state(harvest_job)
+        pending = []
+        for page in partition.list_partitions(
+                client,
+                self._list_verb(),
+                partitions,
+                self.gather_workers,
+                self.gather_retries,
+                split):
+            self._gather_page(
+                harvest_job,
+                page,
+                harvest_obj_ids,
+                guids,
+                pending
+            )
+        self._flush_objects(pending)
+        return harvest_obj_ids
+
+    def _gather_page(self, harvest_job, page, harvest_obj_ids, guids,
+                     pending):
+        """
+        Creates the HarvestObjects of the records of a page which were
+        not gathered yet. Returns the last created object or None.
+
+        Deleted records get no HarvestObject, their packages are
+        deleted once the objects of the page were inserted.
+        """
+        harvest_obj = None
+        deleted = []
+        for header, metadata in page.records:
+            if header.identifier() in guids:
+                continue
+            if header.isDeleted():
+                deleted.append(header.identifier())
+                guids.add(header.identifier())
+                continue
+            if self.harvest_mode == 'list_records' and metadata is None:
+                log.debug('No metadata for %s' % header.identifier())
+                continue
+            harvest_obj = self._create_object(harvest_job, header, metadata)
+            pending.append(harvest_obj)
+            harvest_obj_ids.append(harvest_obj.id)
+            guids.add(header.identifier())
+            if len(pending) >= self.gather_batch_size:
+                self._flush_objects(pending)
+
+        if deleted:
+            self._delete_records(harvest_job, deleted, pending)
+        return harvest_obj
+
+    def _create_object(self, harvest_job, header, metadata):
+        """
+        Adds the HarvestObject of a record to the session, with its
+        content if the metadata was listed
+        """
+        # the id is set here (instead of on insert) so that the
+        # objects of a batch can be inserted with one statement
+        harvest_obj = HarvestObject(
+            id=make_uuid(),
+            guid=header.identifier(),
+            job=harvest_job
+        )
+        if metadata is not None:
+            # content is already known, fetch_stage will skip
+            # the GetRecord request for this object
+            try:
+                self._set_content(
+                    harvest_obj,
+                    self._get_record_content(header, metadata)
+                )
+            except Exception:
+                # leave the content empty, fetch_stage will
+                # fall back to GetRecord for this object
+                log.exception(
+                    'Dumping the metadata of %s failed!'
+                    % header.identifier()
+                )
+        Session.add(harvest_obj)
+        return harvest_obj
+
+    def _delete_records(self, harvest_job, guids, pending):
+        # the actions commit, which must not happen half-way
+        # through a batch
+        self._flush_objects(pending)
+        for guid in guids:
+            self._delete_record(harvest_job, guid)
+
+    def _delete_record(self, harvest_job, guid):
+        """
+        Deletes the package of a deleted record, or makes it private if
+        `deleted_records` is 'withdraw'. The objects of the record are
+        not current anymore, so the record is imported again should it
+        come back.
+        """
+        Session.query(HarvestObject) \
+            .filter(HarvestObject.guid == guid) \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id) \
+            .filter(HarvestObject.current.is_(True)) \
+            .update({'current': False}, synchronize_session=False)
+        Session.commit()
+        if self.deleted_records == 'ignore':
+            return
+
+        context = {
+            'model': model,
+            'session': Session,
+            'user': self.user,
+            'ignore_auth': True
+        }
+        package_id = munge_title_to_name(guid)
+        try:
+            if self.deleted_records == 'withdraw':
+                get_action('package_patch')(
+                    context,
+                    {'id': package_id, 'private': True}
+                )
+            else:
+                get_action('package_delete')(context, {'id': package_id})
+            log.info('%s: package %s of the deleted record %s'
+                     % (self.deleted_records, package_id, guid))
+            metrics.count('deleted', harvest_job.source_id)
+        except NotFound:
+            # the record was never imported
+            Session.rollback()
+        except Exception:
+            log.exception('Could not %s the package %s'
+                          % (self.deleted_records, package_id))
+            Session.rollback()
+
+    def _flush_objects(self, pending):
+        """
+        Inserts the pending HarvestObjects (and checkpoints) with a
+        single commit
+        """
+        Session.commit()
+        del pending[:]
+
+    def _get_gather_state(self, harvest_job):
+        """
+        Returns the ids and guids of the objects which were already
+        gathered for the job and the last stored checkpoint (or None)
+        """
+        objects = Session.query(HarvestObject.id, HarvestObject.guid) \
+            .filter(HarvestObject.harvest_job_id == harvest_job.id) \
+            .order_by(HarvestObject.gathered) \
+            .all()
+        harvest_obj_ids = [obj_id for obj_id, _ in objects]
+        guids = set(guid for _, guid in objects)
+
+        checkpoint = None
+        if objects:
+            extra = Session.query(HarvestObjectExtra.value) \
+                .join(HarvestObjectExtra.object) \
+                .filter(HarvestObject.harvest_job_id == harvest_job.id) \
+                .filter(HarvestObjectExtra.key == 'gather_checkpoint') \
+                .order_by(HarvestObject.gathered.desc()) \
+                .first()
+            if extra:
+                checkpoint = json.loads(extra.value)
+        return harvest_obj_ids, guids, checkpoint
+
+    def _get_checkpoint(self, checkpoint, page):
+        # the cursor is the number of records listed before the next page
+        if page.cursor is not None:
+            cursor = page.cursor + page.count
+        elif checkpoint:
+            cursor = checkpoint['cursor'] + page.count
         else:
-            for header in client.listIdentifiers(
-                    metadataPrefix=self.md_format):
+            cursor = page.count
+        # the latest datestamp listed so far, an expired token restarts
+        # the listing from there
+        datestamp = checkpoint.get('datestamp') if checkpoint else None
+        if page.datestamp is not None:
+            datestamp = max(datestamp, page.datestamp.isoformat())
+        return {'token': page.token, 'cursor': cursor, 'datestamp': datestamp}
+
+    def _list_verb(self):
+        if self.harvest_mode == 'list_records':
+            return 'ListRecords'
+        return 'ListIdentifiers'
+
+    def _page_generator(self, client, token=None, verb=None):
+        """
+        Yields the pages of the list request of the harvest mode,
+        starting at the page of the resumption token if given
+        """
+        if verb is None:
+            verb = self._list_verb()
+        try:
+            for page in listing.list_pages(
+                    client, verb, self._list_arguments(), token):
+                yield page
+        except oaipmh.error.NoRecordsMatchError:
+            log.info('No records to harvest')
+
+    def _identifier_generator(self, client):
+        for page in self._page_generator(client, verb='ListIdentifiers'):
+            for header, _ in page.records:
                 yield header
 
+    def _get_record_content(self, header, metadata):
+        """
+        Returns the content of a record which is stored in the
+        HarvestObject, encoded with codec.encode
+        """
+        try:
+            metadata_modified = header.datestamp().isoformat()
+        except:
+            metadata_modified = None
+
+        content_dict = metadata.getMap()
+        content_dict['set_spec'] = header.setSpec()
+        if metadata_modified:
+            content_dict['metadata_modified'] = metadata_modified
+        #  log.debug(content_dict)
+        self._archive_record(header, metadata)
+        return codec.encode(content_dict)
+
+    def _archive_record(self, header, metadata):
+        """
+        Stores the raw XML of the record in the archive, if there is
+        one (see archive.py)
+        """
+        raw = getattr(metadata, 'raw', None)
+        if raw is None:
+            return
+        try:
+            archive.get_archive(toolkit.config).put(
+                self.profile.source_id,
+                header.identifier(),
+                header.datestamp(),
+                raw
+            )
+        except Exception:
+            log.exception('Could not archive %s' % header.identifier())
+
+    def rederive_objects(self, harvest_objects):
+        """
+        Derives the content of the harvest objects again from the raw
+        XML of their records in the archive, with the current config,
+        mapping and readers of their source and without requests to
+        the source. Objects whose record is not in the archive keep
+        their content.
+
+        :returns: the harvest objects whose content changed
+        """
+        record_archive = archive.get_archive(toolkit.config)
+        if record_archive is None:
+            raise ValueError(
+                'No record archive configured (ckanext.oaipmh.archive)'
+            )
+        changed = []
+        for harvest_object in harvest_objects:
+            profile = self._get_profile(harvest_object.source)
+            raw = record_archive.get(profile.source_id, harvest_object.guid)
+            if raw is None:
+                continue
+            header, metadata = archive.read_record(
+                raw,
+                profile.registry,
+                profile.settings.md_format
+            )
+            content = self._get_record_content(header, metadata)
+            if content == harvest_object.content:
+                continue
+            self._set_content(harvest_object, content)
+            changed.append(harvest_object)
+        Session.commit()
+        return changed
+
+    def _set_content(self, harvest_object, content):
+        """
+        Sets the content of the harvest object and stores its hash
+        as the extra 'content_hash' (the one extra of the object)
+        """
+        harvest_object.content = content
+        content_hash = _content_hash(content)
+        for extra in harvest_object.extras:
+            if extra.key == 'content_hash':
+                extra.value = content_hash
+                return
+        HarvestObjectExtra(
+            object=harvest_object,
+            key='content_hash',
+            value=content_hash
+        )
+
+    def _is_unchanged(self, harvest_object):
+        """
+        Returns True if the current object of the same record, which was
+        imported before, has the same content hash (the latest gathered
+        one, should there be several current objects)
+        """
+        previous_hash = Session.query(HarvestObjectExtra.value) \
+            .join(HarvestObject,
+                  HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(HarvestObject.current.is_(True)) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObjectExtra.key == 'content_hash') \
+            .order_by(HarvestObject.gathered.desc(),
+                      HarvestObjectExtra.id.desc()) \
+            .first()
+        return (previous_hash is not None and
+                previous_hash[0] == _content_hash(harvest_object.content))
+
+    def _get_client(self, source):
+        """
+        Returns the client of the source, using the metadata registry
+        of the current profile. Clients are cached per source URL and
+        config in the process.
+        """
+        def create_client():
+            return transport.Client(
+                source.url,
+                self.profile.registry,
+                self.credentials,
+                force_http_get=self.force_http_get,
+                timeout=self.timeout,
+                pool_size=max(
+                    self.pool_size,
+                    self.max_concurrent_requests,
+                    self.gather_workers
+                ),
+                max_retries=self.max_retries,
+                backoff=self.retry_backoff,
+                adaptive=self.adaptive_concurrency,
+                source_id=source.id
+            )
+        return transport.get_client(
+            (self.__class__, source.url, source.config),
+            create_client
+        )
+
+    def _get_profile(self, source):
+        """
+        Returns the profile of the source and applies it.
+
+        The profile holds everything which follows from the source
+        config alone (settings, mapping, metadata registry). It is
+        compiled once per source and config in the process.
+        """
+        # the config string caches its hash, it is not hashed per call
+        key = (self.__class__, source.id, source.config)
+        profile = _profile_cache.get(key)
+        if profile is None:
+            profile = self._compile_profile(source)
+            _profile_cache.set(key, profile)
+        self._apply_profile(profile)
+        return profile
+
+    def _compile_profile(self, source):
+        if self._set_config(source.config or '') is False:
+            raise ValueError('Invalid source config: %s' % source.config)
+        # as set by _set_config, which a subclass may extend
+        settings = HarvestSettings._make(
+            getattr(self, name) for name in HarvestSettings._fields
+        )
+        # the mapping and the readers depend on the settings
+        mapping = self._get_mapping()
+        reader = self._get_metadata_readers().get(self.md_format)
+        fields = ['set_spec']
+        if reader is not None:
+            fields.extend(list_fields(reader))
+        if self.parse_processes > 0 and self.max_concurrent_requests <= 1:
+            log.warning(
+                'parse_processes of the source %s is ignored, records are '
+                'only parsed in a pool with max_concurrent_requests > 1'
+                % source.id
+            )
+        registry = self._create_metadata_registry()
+        if metrics.enabled:
+            registry = metrics.TimedRegistry(registry, source.id)
+        if archive.get_archive(toolkit.config) is not None:
+            registry = archive.RawRecordRegistry(registry)
+        return HarvestProfile(
+            source_id=source.id,
+            settings=settings,
+            mapping=mapping,
+            mapped_fields=frozenset(mapping.values()),
+            list_fields=tuple(fields),
+            registry=registry
+        )
+
+    def _apply_profile(self, profile):
+        self.profile = profile
+        self._apply_settings(profile.settings)
+
+    def _apply_settings(self, settings):
+        for name, value in zip(HarvestSettings._fields, settings):
+            setattr(self, name, value)
+
+    def _get_metadata_readers(self):
+        return {
+            'oai_dc': oai_dc_reader,
+            'oai_ddi': oai_ddi_reader,
+            # TODO: Change back?
+            # dif_tree_reader returns the same fields as dif_reader2
+            'dif': dif_tree_reader,
+        }
+
     def _create_metadata_registry(self):
         registry = MetadataRegistry()
-        registry.registerReader('oai_dc', oai_dc_reader)
-        registry.registerReader('oai_ddi', oai_ddi_reader)
-        # TODO: Change back?
-        registry.registerReader('dif', dif_reader2)
+        for prefix, reader in self._get_metadata_readers().items():
+            registry.registerReader(prefix, reader)
         return registry
 
     def _set_config(self, source_config):
+        """
+        Parses the source config and sets its settings as attributes
+        of the harvester. Returns False if the config is not valid.
+        """
         try:
             # Set config to empty JSON object
             if not source_config:
@@ -135,21 +860,78 @@ class OaipmhHarvester(HarvesterBase):
 
             config_json = json.loads(source_config)
             #  log.debug('config_json: %s' % config_json)
-            try:
-                username = config_json['username']
-                password = config_json['password']
-                self.credentials = (username, password)
-            except (IndexError, KeyError):
-                self.credentials = None
+            self._apply_settings(self._get_settings(config_json))
+        except ValueError:
+            return False
+        return True
 
-            self.user = 'harvest'
-            self.set_spec = config_json.get('set', None)
-            self.md_format = config_json.get('metadata_prefix', 'dif')
+    def _get_settings(self, config_json):
+        try:
+            username = config_json['username']
+            password = config_json['password']
+            credentials = (username, password)
+        except (IndexError, KeyError):
+            credentials = None
+
+        set_spec = config_json.get('set', None)
+        if isinstance(set_spec, list):
+            set_spec = tuple(set_spec)
+        timeout = config_json.get('timeout', transport.DEFAULT_TIMEOUT)
+        if isinstance(timeout, list):
+            # (connect timeout, read timeout)
+            timeout = tuple(timeout)
+        gather_workers = int(config_json.get('gather_workers', 4))
+        return HarvestSettings(
+            credentials=credentials,
+            user='harvest',
+            set_spec=set_spec,
             # TODO: Change default back to 'oai_dc'
-            self.force_http_get = config_json.get('force_http_get', False)
-
-        except ValueError:
-            pass
+            md_format=config_json.get('metadata_prefix', 'dif'),
+            force_http_get=config_json.get('force_http_get', False),
+            harvest_mode=config_json.get('harvest_mode', 'list_identifiers'),
+            force_all=config_json.get('force_all', False),
+            incremental_overlap=int(
+                config_json.get('incremental_overlap', 3600)
+            ),
+            gather_retries=int(config_json.get('gather_retries', 3)),
+            gather_batch_size=int(
+                config_json.get('gather_batch_size', 1000)
+            ),
+            timeout=timeout,
+            pool_size=int(
+                config_json.get('pool_size', transport.DEFAULT_POOL_SIZE)
+            ),
+            max_concurrent_requests=int(
+                config_json.get('max_concurrent_requests', 1)
+            ),
+            max_retries=int(
+                config_json.get('max_retries', transport.DEFAULT_MAX_RETRIES)
+            ),
+            retry_backoff=float(
+                config_json.get('retry_backoff', transport.DEFAULT_BACKOFF)
+            ),
+            adaptive_concurrency=bool(
+                config_json.get('adaptive_concurrency', True)
+            ),
+            fetch_batch_size=int(config_json.get('fetch_batch_size', 50)),
+            parse_processes=int(config_json.get('parse_processes', 0)),
+            parse_offload_size=int(
+                config_json.get('parse_offload_size', 10000)
+            ),
+            batch_import=bool(config_json.get('batch_import', False)),
+            import_batch_size=int(
+                config_json.get('import_batch_size', 100)
+            ),
+            deleted_records=config_json.get('deleted_records', 'delete'),
+            gather_partitions=config_json.get('gather_partitions'),
+            gather_workers=gather_workers,
+            date_windows=int(
+                config_json.get('date_windows', gather_workers)
+            ),
+            max_window_size=int(
+                config_json.get('max_window_size', 10000)
+            ),
+        )
 
     def fetch_stage(self, harvest_object):
         '''
@@ -167,15 +949,21 @@ class OaipmhHarvester(HarvesterBase):
         '''
         #  log.debug("in fetch stage: %s" % harvest_object.guid)
 
+        if harvest_object.content:
+            # content was already harvested in the gather stage
+            # (harvest_mode 'list_records')
+            return True
+
+        source_id = harvest_object.job.source.id
         try:
-            self._set_config(harvest_object.job.source.config)
-            registry = self._create_metadata_registry()
-            client = oaipmh.client.Client(
-                harvest_object.job.source.url,
-                registry,
-                self.credentials,
-                force_http_get=self.force_http_get
-            )
+            self._get_profile(harvest_object.job.source)
+            client = self._get_client(harvest_object.job.source)
+            if self.max_concurrent_requests > 1:
+                if self._has_error(harvest_object, u'Fetch'):
+                    # failed in the batch of another object of the job
+                    return False
+                return self._fetch_concurrently(client, harvest_object)
+
             record = None
             try:
                 #  log.debug(
@@ -185,44 +973,38 @@ class OaipmhHarvester(HarvesterBase):
 
                 self._before_record_fetch(harvest_object)
 
-                record = client.getRecord(
-                    identifier=harvest_object.guid,
-                    metadataPrefix=self.md_format
-                )
+                with metrics.timer('get_record', source_id):
+                    record = client.getRecord(
+                        identifier=harvest_object.guid,
+                        metadataPrefix=self.md_format
+                    )
                 self._after_record_fetch(record)
 
                 #  log.debug('record found!')
             except:
                 log.exception('getRecord failed')
                 self._save_object_error('Get record failed!', harvest_object)
+                metrics.count('fetch_errors', source_id)
                 return False
 
             header, metadata, _ = record
             #  log.debug('metadata %s' % metadata)
             #  log.debug('header %s' % header)
 
-            try:
-                metadata_modified = header.datestamp().isoformat()
-            except:
-                metadata_modified = None
-
             try:
                 # TODO: This fails for some resources
-                content_dict = metadata.getMap()
-                content_dict['set_spec'] = header.setSpec()
-                if metadata_modified:
-                    content_dict['metadata_modified'] = metadata_modified
-                #  log.debug(content_dict)
-                content = json.dumps(content_dict)
+                with metrics.timer('encode', source_id):
+                    content = self._get_record_content(header, metadata)
             except:
                 log.exception('Dumping the metadata failed!')
                 self._save_object_error(
                     'Dumping the metadata failed!',
                     harvest_object
                 )
+                metrics.count('fetch_errors', source_id)
                 return False
 
-            harvest_object.content = content
+            self._set_content(harvest_object, content)
             harvest_object.save()
         except:
             log.exception('Something went wrong!')
@@ -230,10 +1012,172 @@ class OaipmhHarvester(HarvesterBase):
                 'Exception in fetch stage',
                 harvest_object
             )
+            metrics.count('fetch_errors', source_id)
             return False
+        finally:
+            metrics.flush()
 
+        metrics.count('fetched', source_id)
         return True
 
+    def _fetch_concurrently(self, client, harvest_object):
+        """
+        Fetches the records of a batch of waiting objects of the job
+        (starting with `harvest_object`) with up to
+        `max_concurrent_requests` parallel GetRecord requests and saves
+        their content with one commit. The fetch stage of the other
+        objects of the batch then has nothing left to do.
+
+        The other objects are locked until the commit; concurrent fetch
+        stages skip them, so every object is requested in one batch
+        only. The error of an object whose record could not be fetched
+        is saved, its own fetch stage does not request it again.
+
+        Returns True if the record of `harvest_object` was fetched.
+        """
+        # forked before the objects are locked and the threads started
+        parse_pool = self._get_parse_pool()
+        harvest_objects = [harvest_object] + Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.job.id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.state == u'WAITING') \
+            .filter(HarvestObject.content.is_(None)) \
+            .order_by(HarvestObject.gathered) \
+            .limit(self.fetch_batch_size - 1) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        for obj in harvest_objects:
+            self._before_record_fetch(obj)
+        source = harvest_object.job.source
+
+        pool = ThreadPool(
+            min(self.max_concurrent_requests, len(harvest_objects))
+        )
+        try:
+            results = pool.map(
+                lambda guid: self._fetch_record(
+                    client,
+                    parse_pool,
+                    source,
+                    guid
+                ),
+                [obj.guid for obj in harvest_objects]
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        fetched, failed = self._set_fetched_contents(
+            harvest_objects,
+            results,
+            source.id
+        )
+        for obj, _ in failed:
+            if obj is not harvest_object:
+                # no other batch takes it up once the locks are released
+                obj.state = u'ERROR'
+        Session.commit()
+        for obj, message in failed:
+            self._save_object_error(message, obj)
+        metrics.count('fetched', source.id, fetched)
+        metrics.count('fetch_errors', source.id, len(failed))
+        return harvest_object.content is not None
+
+    def _fetch_record(self, client, parse_pool, source, guid):
+        """
+        Requests the record `guid` in a thread of _fetch_concurrently.
+        Returns (record, None) or, if it was parsed in the parse pool,
+        (None, content), or None if the request failed.
+        """
+        try:
+            if parse_pool is not None:
+                return self._get_record_offloaded(
+                    client,
+                    parse_pool,
+                    PoolSource(source.id, source.config),
+                    guid
+                )
+            with metrics.timer('get_record', source.id):
+                return client.getRecord(
+                    identifier=guid,
+                    metadataPrefix=self.md_format
+                ), None
+        except Exception:
+            log.debug('getRecord of %s failed' % guid, exc_info=True)
+            return None
+
+    def _set_fetched_contents(self, harvest_objects, results, source_id):
+        """
+        Sets the content of the harvest objects from the results of
+        _fetch_record. Returns the number of fetched objects and the
+        (object, message) of the failed ones.
+        """
+        fetched = 0
+        failed = []
+        for obj, result in zip(harvest_objects, results):
+            if result is None:
+                failed.append((obj, 'Get record failed!'))
+                continue
+            try:
+                record, content = result
+                if content is None:
+                    self._after_record_fetch(record)
+                    header, metadata, _ = record
+                    with metrics.timer('encode', source_id):
+                        content = self._get_record_content(header, metadata)
+                self._set_content(obj, content)
+                fetched += 1
+            except Exception:
+                log.debug('Dumping %s failed' % obj.guid, exc_info=True)
+                failed.append((obj, 'Dumping the metadata failed!'))
+        return fetched, failed
+
+    def _get_record_offloaded(self, client, parse_pool, source, guid):
+        """
+        Requests a record and returns (record, None), or (None, content)
+        if the response is at least `parse_offload_size` bytes: it is
+        then parsed and converted to the content in the parse pool,
+        while this thread waits (and the others go on fetching).
+
+        _after_record_fetch is not called for records parsed in the
+        pool, their header and metadata stay in the pool process.
+        """
+        with metrics.timer('get_record', source.id):
+            xml = client.makeRequest(
+                verb='GetRecord',
+                identifier=guid,
+                metadataPrefix=self.md_format
+            )
+        if len(xml) >= self.parse_offload_size:
+            metrics.count('parse_offloaded', source.id)
+            return None, parse_pool.apply(
+                _parse_in_pool,
+                (self.__class__, source, xml)
+            )
+        header, metadata = listing.parse_record(
+            xml,
+            client.getMetadataRegistry(),
+            self.md_format
+        )
+        return (header, metadata, None), None
+
+    def _get_parse_pool(self):
+        """
+        Returns the process pool which parses large records, or None if
+        `parse_processes` is 0. The pool is shared by the harvesters of
+        the process. Its processes do not use the database, they leave
+        the connections of the fetch process alone.
+        """
+        if self.parse_processes <= 0:
+            return None
+        pool = _parse_pools.get(self.parse_processes)
+        if pool is None:
+            pool = _parse_pools[self.parse_processes] = Pool(
+                self.parse_processes,
+                initializer=_init_parse_worker
+            )
+        return pool
+
     def _before_record_fetch(self, harvest_object):
         pass
 
@@ -264,68 +1208,184 @@ class OaipmhHarvester(HarvesterBase):
             self._save_object_error('No harvest object received')
             return False
 
+        source_id = harvest_object.source.id
+        result = None
         try:
-            self._set_config(harvest_object.job.source.config)
-            context = {
-                'model': model,
-                'session': Session,
-                'user': self.user,
-                'ignore_auth': True  # TODO: Remove, just to test
-            }
+            self._get_job_context(harvest_object)
+            if self.batch_import:
+                result = self._import_job_batch(harvest_object)
+        except:
+            log.exception('Something went wrong!')
+            # the failed statement or commit left the transaction aborted
+            Session.rollback()
+            self._save_object_error(
+                'Exception in import stage',
+                harvest_object,
+                u'Import'
+            )
+            metrics.count('import_errors', source_id)
+            metrics.flush()
+            result = False
+        if result is None:
+            result = self._import_object(harvest_object)
+        self._release_job_context(harvest_object)
+        return result
+
+    def _import_object(self, harvest_object):
+        """
+        Imports the harvest object on its own, with one commit
+        """
+        source_id = harvest_object.source.id
+        try:
+            if self._is_unchanged(harvest_object):
+                log.debug('%s is unchanged, skipping' % harvest_object.guid)
+                metrics.count('unchanged', source_id)
+                return 'unchanged'
 
-            package_dict = {}
-            content = json.loads(harvest_object.content)
+            # log.debug('Create/update package using dict: %s' % package_dict)
+            with metrics.timer('import', source_id):
+                package_dict = self._get_package_dict(harvest_object)
 
-            package_dict['id'] = munge_title_to_name(harvest_object.guid)
-            package_dict['name'] = package_dict['id']
+                with metrics.timer('save_package', source_id):
+                    self._create_or_update_package(
+                        package_dict,
+                        harvest_object
+                    )
 
-            mapping = self._get_mapping()
+                with metrics.timer('commit', source_id):
+                    Session.commit()
 
-            for ckan_field, oai_field in mapping.iteritems():
-                try:
-                    if ckan_field == 'maintainer_email' and '@' not in content[oai_field][0]:
-                        # Email not available.
-                        # Do not set email field as it will break validation.
-                        continue
-                    else:
-                        package_dict[ckan_field] = content[oai_field][0]
+            #  log.debug("Finished record")
+        except:
+            log.exception('Something went wrong!')
+            # the failed statement or commit left the transaction aborted
+            Session.rollback()
+            self._save_object_error(
+                'Exception in import stage',
+                harvest_object,
+                u'Import'
+            )
+            metrics.count('import_errors', source_id)
+            return False
+        finally:
+            metrics.flush()
+        metrics.count('imported', source_id)
+        return True
 
-                except (IndexError, KeyError):
+    def _import_job_batch(self, harvest_object):
+        """
+        Imports the harvest object together with up to
+        `import_batch_size` - 1 fetched objects of its job which no
+        import stage took up yet, with one commit and one index update
+        (see import_objects).
+
+        The other objects are locked until the commit and are then
+        completed (or failed); their own import stage has nothing left
+        to do. Concurrent import stages skip the locked objects, so
+        every object is in one batch only.
+        """
+        if harvest_object.current and harvest_object.package_id:
+            # imported with the batch of another object of the job
+            return True
+        if self._has_error(harvest_object, u'Import'):
+            # failed in the batch of another object of the job
+            return False
+        others = Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id ==
+                    harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.state == u'WAITING') \
+            .filter(HarvestObject.content.isnot(None)) \
+            .order_by(HarvestObject.gathered) \
+            .limit(self.import_batch_size - 1) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        harvest_objects = [harvest_object] + others
+        self._import_batch(harvest_objects)
+        for obj in others:
+            obj.state = u'ERROR' if self._has_error(obj, u'Import') \
+                else u'COMPLETE'
+        Session.commit()
+        if self._has_error(harvest_object, u'Import'):
+            return False
+        if not harvest_object.current:
+            return 'unchanged'
+        return True
+
+    def _has_error(self, harvest_object, stage):
+        return Session.query(exists().where(
+            (HarvestObjectError.harvest_object_id == harvest_object.id) &
+            (HarvestObjectError.stage == stage)
+        )).scalar()
+
+    def _get_package_dict(self, harvest_object, defer_commit=False):
+        """
+        Builds the package dict of the fetched content of the harvest
+        object. Groups which do not exist yet are created, with
+        `defer_commit` they are not committed.
+        """
+        job_context = self._get_job_context(harvest_object)
+        context = {
+            'model': model,
+            'session': Session,
+            'user': job_context['user'],
+            'ignore_auth': True  # TODO: Remove, just to test
+        }
+        if defer_commit:
+            context['defer_commit'] = True
+
+        package_dict = {}
+        content = codec.decode(
+            harvest_object.content,
+            job_context['profile'].list_fields
+        )
+
+        package_dict['id'] = munge_title_to_name(harvest_object.guid)
+        package_dict['name'] = package_dict['id']
+
+        mapping = job_context['profile'].mapping
+
+        for ckan_field, oai_field in mapping.iteritems():
+            try:
+                if ckan_field == 'maintainer_email' and '@' not in content[oai_field][0]:
+                    # Email not available.
+                    # Do not set email field as it will break validation.
                     continue
+                else:
+                    package_dict[ckan_field] = content[oai_field][0]
 
-            # add author
-            # TODO: Remove Dataset_Creator and/or Dataset_Publisher as it is redundant information
-            package_dict['author'] = self._extract_author(content)
+            except (IndexError, KeyError):
+                continue
 
-            # add owner_org
-            source_dataset = get_action('package_show')(
-              context,
-              {'id': harvest_object.source.id}
-            )
-            owner_org = source_dataset.get('owner_org')
-            package_dict['owner_org'] = owner_org
+        # add author
+        # TODO: Remove Dataset_Creator and/or Dataset_Publisher as it is redundant information
+        package_dict['author'] = self._extract_author(content)
+
+        # add owner_org
+        package_dict['owner_org'] = job_context['owner_org']
 
-            # add license
-            package_dict['license_id'] = self._extract_license_id(content)
+        # add license
+        package_dict['license_id'] = self._extract_license_id(content)
 
-            # TODO: Need to map to CKAN author field
-            formats = self._extract_formats(content)
-            package_dict['formats'] = formats
+        # TODO: Need to map to CKAN author field
+        formats = self._extract_formats(content)
+        package_dict['formats'] = formats
 
-            # add resources
-            # TODO: Make list
-            url = self._get_possible_resource(harvest_object, content)
-            package_dict['resources'] = self._extract_resources(url, content)
+        # add resources
+        # TODO: Make list
+        url = self._get_possible_resource(harvest_object, content)
+        package_dict['resources'] = self._extract_resources(url, content)
 
-            # extract tags from 'type' and 'subject' field
-            # everything else is added as extra field
-            tags, extras = self._extract_tags_and_extras(content)
-            package_dict['tags'] = tags
-            package_dict['extras'] = extras
+        # extract tags from 'type' and 'subject' field
+        # everything else is added as extra field
+        tags, extras = self._extract_tags_and_extras(content)
+        package_dict['tags'] = tags
+        package_dict['extras'] = extras
 
-            # groups aka projects
-            groups = []
+        # groups aka projects
+        groups = []
 
+        with metrics.timer('groups', harvest_object.source.id):
             # create group based on set
             if content['set_spec']:
                 #  log.debug('set_spec: %s' % content['set_spec'])
@@ -341,32 +1401,195 @@ class OaipmhHarvester(HarvesterBase):
                 self._extract_groups(content, context)
             )
 
-            package_dict['groups'] = groups
+        package_dict['groups'] = groups
 
-            # allow sub-classes to add additional fields
-            package_dict = self._extract_additional_fields(
-                content,
-                package_dict
-            )
+        # allow sub-classes to add additional fields
+        package_dict = self._extract_additional_fields(
+            content,
+            package_dict
+        )
+        return package_dict
+
+    def import_objects(self, harvest_objects, batch_size=None):
+        """
+        Imports the harvest objects in batches of `batch_size` records
+        (by default the import_batch_size of the source config).
 
+        Unlike import_stage (without `batch_import`), which commits and
+        indexes every package on its own, every batch is committed once
+        and its packages are indexed together. A record which fails is
+        rolled back alone and its error is saved as in import_stage.
 
-            # log.debug('Create/update package using dict: %s' % package_dict)
-            self._create_or_update_package(
-                package_dict,
-                harvest_object
+        :returns: the number of imported (not unchanged) harvest objects
+        """
+        if not harvest_objects:
+            return 0
+        if batch_size is None:
+            self._get_job_context(harvest_objects[0])
+            batch_size = self.import_batch_size
+
+        imported = 0
+        for start in range(0, len(harvest_objects), batch_size):
+            imported += self._import_batch(
+                harvest_objects[start:start + batch_size]
             )
+        return imported
+
+    def _import_batch(self, harvest_objects):
+        source_id = harvest_objects[0].source.id
+        package_ids = []
+        unchanged = 0
+        # errors of the records are saved once the batch is committed
+        self._batch_errors = []
+        try:
+            for harvest_object in harvest_objects:
+                savepoint = Session.begin_nested()
+                self._created_groups = []
+                try:
+                    if self._is_unchanged(harvest_object):
+                        savepoint.commit()
+                        unchanged += 1
+                        continue
+                    with metrics.timer('import', source_id):
+                        package_dict = self._get_package_dict(
+                            harvest_object,
+                            defer_commit=True
+                        )
+                        with metrics.timer('save_package', source_id):
+                            with _commits_deferred():
+                                result = self._create_or_update_package(
+                                    package_dict,
+                                    harvest_object
+                                )
+                except Exception:
+                    log.exception('Something went wrong!')
+                    self._save_object_error(
+                        'Exception in import stage',
+                        harvest_object,
+                        'Import'
+                    )
+                    result = None
+                if result is None:
+                    # _create_or_update_package saved the error
+                    savepoint.rollback()
+                    # the groups created for the record are gone as well
+                    for group_name in self._created_groups:
+                        _group_cache.pop(group_name)
+                    continue
+                savepoint.commit()
+                if result == 'unchanged':
+                    unchanged += 1
+                else:
+                    package_ids.append(harvest_object.package_id)
+            try:
+                with metrics.timer('commit', source_id):
+                    Session.commit()
+                committed = True
+            except Exception:
+                log.exception('Could not commit the import batch')
+                Session.rollback()
+                committed = False
+            batch_errors = self._batch_errors
+        finally:
+            self._batch_errors = None
+            self._created_groups = None
+
+        if not committed:
+            # find the failing records by importing them one by one
+            return len([
+                o for o in harvest_objects if self._import_object(o) is True
+            ])
+
+        for args in batch_errors:
+            self._save_object_error(*args)
+        if package_ids:
+            with metrics.timer('index', source_id):
+                self._index_packages(package_ids)
+        metrics.count('imported', source_id, len(package_ids))
+        metrics.count('unchanged', source_id, unchanged)
+        metrics.count('import_errors', source_id, len(batch_errors))
+        metrics.flush()
+        return len(package_ids)
+
+    def _index_packages(self, package_ids):
+        """
+        Indexes the packages of a batch all at once, with one commit of
+        the search index. They are indexed here whatever the config of
+        the consumer, the rollback of a failed record may drop the
+        packages which CKAN would index on the commit of the batch.
+        """
+        search.rebuild(package_ids=package_ids, defer_commit=True)
+        search.commit()
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        if self._batch_errors is not None:
+            # in an import batch, saved after its commit
+            self._batch_errors.append((message, obj, stage, line))
+            return
+        super(OaipmhHarvester, self)._save_object_error(
+            message,
+            obj,
+            stage,
+            line
+        )
+
+    def _get_job_context(self, harvest_object):
+        """
+        Returns the settings which are the same for all records of the
+        job of the harvest object (profile, user and owner_org of the
+        source) and applies the config.
 
-            Session.commit()
+        They are looked up once per job and cached in the process until
+        the job is done, see _release_job_context.
+        """
+        job = harvest_object.job
+        job_context = _job_context_cache.get(job.id)
+        if job_context:
+            self._apply_profile(job_context['profile'])
+            return job_context
+
+        profile = self._get_profile(job.source)
+        context = {
+            'model': model,
+            'session': Session,
+            'user': self.user,
+            'ignore_auth': True
+        }
+        source_dataset = get_action('package_show')(
+            context,
+            {'id': harvest_object.source.id}
+        )
+        job_context = {
+            'job_id': job.id,
+            'profile': profile,
+            'user': self.user,
+            'owner_org': source_dataset.get('owner_org'),
+        }
+        _job_context_cache.set(job.id, job_context)
+        return job_context
 
-            #  log.debug("Finished record")
-        except:
-            log.exception('Something went wrong!')
-            self._save_object_error(
-                'Exception in import stage',
-                harvest_object
-            )
-            return False
-        return True
+    def _release_job_context(self, harvest_object):
+        """
+        Drops the cached context of the job of the harvest object once
+        no other object of the job is left to fetch or import. (The
+        contexts in other processes, which did not import the last
+        records, expire.)
+        """
+        try:
+            pending = Session.query(exists().where(
+                (HarvestObject.harvest_job_id ==
+                 harvest_object.harvest_job_id) &
+                (HarvestObject.id != harvest_object.id) &
+                (HarvestObject.state.in_(
+                    [u'WAITING', u'FETCH', u'IMPORT']
+                ))
+            )).scalar()
+        except Exception:
+            log.exception('Could not check whether the job is done')
+            Session.rollback()
+            return
+        if not pending:
+            _job_context_cache.pop(harvest_object.harvest_job_id)
 
     def _get_mapping(self):
         if self.md_format == 'dif':
@@ -430,7 +1653,7 @@ class OaipmhHarvester(HarvesterBase):
         extras = []
         tags = []
         for key, value in content.iteritems():
-            if key in self._get_mapping().values():
+            if key in self.profile.mapped_fields:
                 continue
             if key in ['type', 'subject']:
                 if type(value) is list:
@@ -542,18 +1765,36 @@ class OaipmhHarvester(HarvesterBase):
         #  log.debug('Group names: %s' % groups)
         group_ids = []
         for group_name in groups:
-            data_dict = {
-                'id': group_name,
-                'name': munge_title_to_name(group_name),
-                'title': group_name
-            }
-            try:
-                group = get_action('group_show')(context, data_dict)
-                #  log.info('found the group ' + group['id'])
-            except:
-                group = get_action('group_create')(context, data_dict)
-                log.info('created the group ' + group['id'])
-            group_ids.append(group['id'])
+            group_id = _group_cache.get(group_name)
+            if group_id is None:
+                group_id = self._find_or_create_group(group_name, context)
+            group_ids.append(group_id)
 
         #  log.debug('Group ids: %s' % group_ids)
         return group_ids
+
+    def _find_or_create_group(self, group_name, context):
+        """
+        Returns the id of the group, which is created if it does not
+        exist yet. The id is cached per process, failures are not.
+        """
+        data_dict = {
+            'id': group_name,
+            'name': munge_title_to_name(group_name),
+            'title': group_name
+        }
+        try:
+            group = get_action('group_show')(context, data_dict)
+            #  log.info('found the group ' + group['id'])
+        except NotFound:
+            try:
+                group = get_action('group_create')(context, data_dict)
+                log.info('created the group ' + group['id'])
+                if self._created_groups is not None:
+                    self._created_groups.append(group_name)
+            except ValidationError:
+                # the group may have been created by another
+                # consumer in the meantime
+                group = get_action('group_show')(context, data_dict)
+        _group_cache.set(group_name, group['id'])
+        return group['id']
@@ -0,0 +1,204 @@
+"""
+Paging through the list requests (ListIdentifiers, ListRecords) of an
+OAI-PMH repository.
+
+pyoai hides the resumption tokens of the pages, which are needed to
+continue an interrupted harvest, and builds the whole element tree of
+every page. Here the pages are parsed with iterparse while they are
+read from the connection (with the client of transport.py) and every
+record is removed from the tree once it was handled, so the memory
+used does not depend on the size of the pages.
+"""
+from io import BytesIO
+
+from lxml import etree
+from oaipmh import error
+from oaipmh.client import buildHeader
+from oaipmh.datestamp import datetime_to_datestamp
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+HEADER_TAG = '{%s}header' % OAI_NS
+RECORD_TAG = '{%s}record' % OAI_NS
+METADATA_TAG = '{%s}metadata' % OAI_NS
+TOKEN_TAG = '{%s}resumptionToken' % OAI_NS
+ERROR_TAG = '{%s}error' % OAI_NS
+GET_RECORD_TAG = '{%s}GetRecord' % OAI_NS
+
+NAMESPACES = {'oai': OAI_NS}
+
+ERROR_CODES = [
+    'badArgument', 'badResumptionToken', 'badVerb',
+    'cannotDisseminateFormat', 'idDoesNotExist', 'noRecordsMatch',
+    'noMetadataFormats', 'noSetHierarchy'
+]
+
+
+class Page(object):
+    """One response page of a list request.
+
+    `records` yields (header, metadata) tuples, metadata is None for
+    ListIdentifiers. The page is parsed while the records are read,
+    `token` (the resumption token of the next page or None on the last
+    page), `cursor`, `complete_list_size`, `count` (the number of
+    records of the page) and `datestamp` (the latest datestamp of its
+    records) are set once all records of the page were read.
+    """
+    def __init__(self):
+        self.records = iter(())
+        self.count = 0
+        self.datestamp = None
+        self.token = None
+        self.cursor = None
+        self.complete_list_size = None
+
+
+def list_pages(client, verb, args, token=None):
+    """Yields the pages of a list request.
+
+    If a resumption token is given the listing continues with the page
+    of this token, otherwise it starts with the arguments `args`.
+    OAI-PMH errors of a page are raised before the page is yielded.
+    """
+    while True:
+        if token:
+            kw = {'verb': verb, 'resumptionToken': token}
+        else:
+            kw = _request_arguments(client, args)
+            kw['verb'] = verb
+        page = Page()
+        records = _parse_records(page, client, args['metadataPrefix'], kw,
+                                 _request(client, kw))
+        # read up to the first record to raise errors right away
+        first = next(records, None)
+        if first is not None:
+            page.records = _chain(first, records)
+        yield page
+
+        # parse the rest of the page if the records were not all read
+        for _ in page.records:
+            pass
+        if not page.token:
+            break
+        token = page.token
+
+
+def _request(client, kw):
+    """Returns the body of the response to a request as a file object.
+    The client of transport.py streams it from the connection, other
+    (pyoai) clients return the whole response.
+    """
+    if hasattr(client, 'streamRequest'):
+        return client.streamRequest(**kw)
+    return BytesIO(client.makeRequest(**kw))
+
+
+def _chain(first, records):
+    yield first
+    for record in records:
+        yield record
+
+
+def _request_arguments(client, args):
+    # encode datetimes as datestamps, like pyoai does
+    kw = dict(args)
+    from_ = kw.pop('from_', None)
+    if from_ is not None:
+        kw['from'] = datetime_to_datestamp(from_, client._day_granularity)
+    until = kw.pop('until', None)
+    if until is not None:
+        kw['until'] = datetime_to_datestamp(until, client._day_granularity)
+    return kw
+
+
+def _parse_records(page, client, metadata_prefix, kw, body):
+    if kw['verb'] == 'ListRecords':
+        item_tag = RECORD_TAG
+    else:
+        item_tag = HEADER_TAG
+    namespaces = client.getNamespaces()
+    registry = client.getMetadataRegistry()
+    events = etree.iterparse(
+        body,
+        events=('end',),
+        tag=(item_tag, TOKEN_TAG, ERROR_TAG)
+    )
+    try:
+        for _, node in events:
+            if node.tag == ERROR_TAG:
+                _raise_error(node)
+            elif node.tag == TOKEN_TAG:
+                _read_token(page, node)
+            elif item_tag == RECORD_TAG:
+                record = _build_record(node, namespaces, registry,
+                                       metadata_prefix)
+                _add_record(page, record[0])
+                yield record
+            else:
+                header = buildHeader(node, namespaces)
+                _add_record(page, header)
+                yield header, None
+
+            # the record was handled, remove it from the tree
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+    except etree.XMLSyntaxError:
+        raise error.XMLSyntaxError(kw)
+    finally:
+        # also when the records are not read to the end
+        body.close()
+
+
+def _add_record(page, header):
+    page.count += 1
+    if page.datestamp is None or header.datestamp() > page.datestamp:
+        page.datestamp = header.datestamp()
+
+
+def parse_record(xml, registry, metadata_prefix):
+    """Returns the (header, metadata) of the record of a GetRecord
+    response. The OAI-PMH error of the response is raised.
+    """
+    try:
+        tree = etree.fromstring(xml)
+    except etree.XMLSyntaxError:
+        raise error.XMLSyntaxError(xml[:100])
+    error_node = tree.find(ERROR_TAG)
+    if error_node is not None:
+        _raise_error(error_node)
+    record = tree.find('%s/%s' % (GET_RECORD_TAG, RECORD_TAG))
+    if record is None:
+        raise error.UnknownError('No record in the GetRecord response')
+    return _build_record(record, NAMESPACES, registry, metadata_prefix)
+
+
+def _build_record(node, namespaces, registry, metadata_prefix):
+    header = buildHeader(node.find(HEADER_TAG), namespaces)
+    metadata_node = node.find(METADATA_TAG)
+    if metadata_node is None:
+        return header, None
+    return header, registry.readMetadata(metadata_prefix, metadata_node)
+
+
+def _read_token(page, node):
+    page.token = (node.text or '').strip() or None
+    page.cursor = _int_attribute(node, 'cursor')
+    page.complete_list_size = _int_attribute(node, 'completeListSize')
+
+
+def _raise_error(node):
+    code = node.get('code')
+    msg = node.text
+    if code not in ERROR_CODES:
+        raise error.UnknownError(
+            "Unknown error code from server: %s, message: %s"
+            % (code, msg)
+        )
+    raise getattr(error, code[0].upper() + code[1:] + 'Error')(msg)
+
+
+def _int_attribute(node, name):
+    try:
+        return int(node.get(name))
+    except (TypeError, ValueError):
+        return None
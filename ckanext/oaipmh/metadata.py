@@ -6,8 +6,10 @@ from lxml import etree
 
 if sys.version_info[0] == 3:
     text_type = str
+    string_types = (str,)
 else:
     text_type = unicode # noqa
+    string_types = (basestring,) # noqa
 
 
 class Error(Exception):
@@ -16,38 +18,123 @@ class Error(Exception):
 
 class MetadataReader(object):
     """A default implementation of a reader based on fields.
+
+    The xpath expressions of the fields are compiled once when the
+    reader is created.
     """
     def __init__(self, fields, namespaces=None):
         self._fields = fields
         self._namespaces = namespaces or {}
+        self._compiled_fields = []
+        for field_name, (field_type, expr) in list(self._fields.items()):
+            if field_type not in _converters:
+                raise Error("Unknown field type: %s" % field_type)
+            self._compiled_fields.append((
+                field_name,
+                _converters[field_type],
+                etree.XPath(expr, namespaces=self._namespaces)
+            ))
 
     # TODO: Debug the paths for DIF
     def __call__(self, element):
         map = {}
-        # create XPathEvaluator for this element
-        xpath_evaluator = etree.XPathEvaluator(element,
-                                               namespaces=self._namespaces)
-
-        e = xpath_evaluator.evaluate
         # now extra field info according to xpath expr
-        for field_name, (field_type, expr) in list(self._fields.items()):
-            if field_type == 'bytes':
-                value = str(e(expr))
-            elif field_type == 'bytesList':
-                value = [str(item) for item in e(expr)]
-            elif field_type == 'text':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = text_type(e(expr))
-            elif field_type == 'textList':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = [text_type(v) for v in e(expr)]
-            else:
+        for field_name, convert, xpath in self._compiled_fields:
+            map[field_name] = convert(xpath(element))
+        return common.Metadata(element, map)
+
+
+def list_fields(reader):
+    """Returns the names of the fields of a reader whose values are
+    lists
+    """
+    return [
+        field_name
+        for field_name, (field_type, _) in reader._fields.items()
+        if field_type.endswith('List')
+    ]
+
+
+# make sure we get back unicode strings instead
+# of lxml.etree._ElementUnicodeResult objects.
+_converters = {
+    'bytes': str,
+    'bytesList': lambda value: [str(item) for item in value],
+    'text': text_type,
+    'textList': lambda value: [text_type(v) for v in value],
+}
+
+
+class TreeWalkReader(object):
+    """A reader for fields given as lists of element names (without
+    namespaces), see _eval_builder.
+
+    Returns the same map as a MetadataReader with the xpaths of
+    _xpath_bulder, but walks the element tree of a record only once
+    instead of scanning all descendants for every field.
+    """
+    def __init__(self, fields):
+        self._fields = fields
+        # element name -> [(field name, names of the ancestors, converter)]
+        self._paths = {}
+        for field_name, (field_type, elms) in list(fields.items()):
+            if field_type not in _converters:
                 raise Error("Unknown field type: %s" % field_type)
-            map[field_name] = value
+            if len(elms) < 2 or elms[-1] != 'text()':
+                raise Error("Unsupported path: %s" % field_name)
+            self._paths.setdefault(elms[-2], []).append(
+                (field_name, tuple(elms[:-2]))
+            )
+
+    def __call__(self, element):
+        values = dict((field_name, []) for field_name in self._fields)
+        for child in element:
+            if isinstance(child.tag, string_types):
+                self._walk(child, [], values)
+        map = {}
+        for field_name, (field_type, _) in list(self._fields.items()):
+            map[field_name] = _converters[field_type](values[field_name])
         return common.Metadata(element, map)
 
+    def _walk(self, node, ancestors, values):
+        # name() of xpath is the qualified name of the element
+        name = node.tag.rpartition('}')[2]
+        if node.prefix:
+            name = node.prefix + ':' + name
+
+        fields = [
+            field_name
+            for field_name, path in self._paths.get(name, ())
+            if _has_ancestors(ancestors, path)
+        ]
+        # collect the text nodes in document order
+        if fields and node.text is not None:
+            for field_name in fields:
+                values[field_name].append(node.text)
+        ancestors.append(name)
+        for child in node:
+            if isinstance(child.tag, string_types):
+                self._walk(child, ancestors, values)
+            if fields and child.tail is not None:
+                for field_name in fields:
+                    values[field_name].append(child.tail)
+        ancestors.pop()
+
+
+def _has_ancestors(ancestors, path):
+    """Checks if the names in `path` appear in this order (not
+    necessarily directly nested) in the list of ancestor names
+    """
+    i = len(ancestors)
+    for name in reversed(path):
+        while i > 0:
+            i -= 1
+            if ancestors[i] == name:
+                break
+        else:
+            return False
+    return True
+
 
 oai_ddi_reader = MetadataReader(
     fields={
@@ -132,8 +219,11 @@ dif_reader = MetadataReader(
 
 # Builds an xpath based on a list of elements
 # Meant for xml parsing without namespaces
+# The path is relative to the metadata element, so that only the
+# current record is searched when a page contains several records
+# (ListRecords)
 def _xpath_bulder(elms):
-    path = ""
+    path = "."
     for i, elm in enumerate(elms):
         if i == len(elms) - 1:
             path += "/"
@@ -149,123 +239,132 @@ def _eval_builder(field_type, elms):
     return (field_type, _xpath_bulder(elms))
 
 
+# Fields of DIF records as element names without namespaces
 # TODO: Should use absolute paths whenever possible.
 #       Helps avoid namespace conflicts.
+dif_fields = {
+    # Basic info
+    "Entry_ID": ('textList', ['Entry_ID', 'text()']),
+    "Entry_Title": ('textList', ['Entry_Title', 'text()']),
+
+    # Dataset citation
+    "Data_Set_Citation/Dataset_Creator": ('textList', ['Dataset_Creator', 'text()']),
+    "Data_Set_Citation/Dataset_Title": ('textList', ['Dataset_Title', 'text()']),
+    "Data_Set_Citation/Dataset_Release_Date": ('textList', ['Dataset_Release_Date', 'text()']),
+    "Data_Set_Citation/Dataset_Release_Place": ('textList', ['Dataset_Release_Place', 'text()']),
+    "Data_Set_Citation/Dataset_Publisher": ('textList', ['Dataset_Publisher', 'text()']),
+    "Data_Set_Citation/Version": ('textList', ['Version', 'text()']),
+
+    # Personnel
+    "Personnel/Role": ('textList', ['Personnel', 'Role', 'text()']),
+    "Personnel/First_Name": ('textList', ['Personnel', 'First_Name', 'text()']),
+    "Personnel/Last_Name": ('textList', ['Personnel', 'Last_Name', 'text()']),
+    "Personnel/Email": ('textList', ['Personnel', 'Email', 'text()']),
+    "Personnel/Phone": ('textList', ['Personnel', 'Phone', 'text()']),
+
+    # Personnel contact address
+    "Personnel/Contact_Address/Address": ('textList', ['Personnel', 'Contact_Address', 'Address', 'text()']),
+    "Personnel/Contact_Address/City": ('textList', ['Personnel', 'Contact_Address', 'City', 'text()']),
+    "Personnel/Contact_Address/Postal_Code": ('textList', ['Personnel', 'Contact_Address', 'Postal_Code', 'text()']),
+    "Personnel/Contact_Address/Country": ('textList', ['Personnel', 'Contact_Address', 'Country', 'text()']),
+
+    # Parameters
+    "Keyword": ('textList', ['Keyword', 'text()']),
+
+    # Termporal coverage
+    "Temporal_Coverage/Start_Date": ('textList', ['Temporal_Coverage', 'Start_Date', 'text()']),
+    "Temporal_Coverage/Stop_Date": ('textList', ['Temporal_Coverage', 'Stop_Date', 'text()']),
+
+    # Data_Set_Progress
+    "Data_Set_Progress": ('textList', ['Data_Set_Progress', 'text()']),
+
+    # Spatial_Coverage
+    "Spatial_Coverage/Southernmost_lat": ('textList', ['Spatial_Coverage', 'Southernmost_Latitude', 'text()']),
+    "Spatial_Coverage/Northernmost_lat": ('textList', ['Spatial_Coverage', 'Northernmost_Latitude', 'text()']),
+    "Spatial_Coverage/Westernmost_lon": ('textList', ['Spatial_Coverage', 'Westernmost_Longitude', 'text()']),
+    "Spatial_Coverage/Easternmost_lon": ('textList', ['Spatial_Coverage', 'Easternmost_Longitude', 'text()']),
+
+    # Project
+    "Project/Short_Name": ('textList', ['Project', 'Short_Name', 'text()']),
+    "Project/Long_Name": ('textList', ['Project', 'Long_Name', 'text()']),
+
+    "Access_Constraints": ('textList', ['Access_Constraints', 'text()']),
+    "Use_Constraints": ('textList', ['Use_Constraints', 'text()']),
+    "Data_Set_Language": ('textList', ['Data_Set_Language', 'text()']),
+    "Originating_Center": ('textList', ['Originating_Center', 'text()']),
+
+    # Data center
+    "Data_Center/Data_Center_Name/Short_Name": ('textList', ['Data_Center', 'Data_Center_Name', 'Short_Name', 'text()']),
+    "Data_Center/Data_Center_Name/Long_Name": ('textList', ['Data_Center', 'Data_Center_Name', 'Long_Name', 'text()']),
+    "Data_Center/Data_Center_URL": ('textList', ['Data_Center', 'Data_Center_URL', 'text()']),
+    # Personnel
+    "Data_Center/Personnel/Role": ('textList', ['Data_Center', 'Personnel', 'Role', 'text()']),
+    "Data_Center/Personnel/First_Name": ('textList', ['Data_Center', 'Personnel', 'First_Name', 'text()']),
+    "Data_Center/Personnel/Last_Name": ('textList', ['Data_Center', 'Personnel', 'Last_Name', 'text()']),
+    "Data_Center/Personnel/Email": ('textList', ['Data_Center', 'Personnel', 'Email', 'text()']),
+    "Data_Center/Personnel/Phone": ('textList', ['Data_Center', 'Personnel', 'Phone', 'text()']),
+    "Data_Center/Personnel/Contact_Address/Address": ('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Address', 'text()']),
+    "Data_Center/Personnel/Contact_Address/City": ('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'City', 'text()']),
+    "Data_Center/Personnel/Contact_Address/Postal_Code": ('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Postal_Code', 'text()']),
+    "Data_Center/Personnel/Contact_Address/Country": ('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Country', 'text()']),
+
+    # Reference
+    # TODO: Might contain 'Author' etc.
+    "Reference": ('textList', ['Reference', 'text()']),
+
+    # Summary
+    "Summary/Abstract": ('textList', ['Summary', 'Abstract', 'text()']),
+    
+    # Related URLs
+    "Related_URL/URL_Content_Type/Type": ('textList', ['Related_URL', 'URL_Content_Type', 'Type', 'text()']),
+    # TODO: Add empty subtype if it does not exist.
+    #       How to connect Type and its corrent Subtype. The indices are currently wrong.
+    "Related_URL/URL_Content_Type/Subtype": ('textList', ['Related_URL', 'URL_Content_Type', 'Subtype', 'text()']),
+    # TODO: Same for this
+    "Related_URL/URL": ('textList', ['Related_URL', 'URL', 'text()']),
+    # TODO: Same for this
+    "Related_URL/Description": ('textList', ['Related_URL', 'Description', 'text()']),
+
+    # IDN Node
+    # TODO: Usually not displayed to the user
+    "IDN_Node/Short_Name": ('textList', ['IDN_Node', 'Short_Name', 'text()']),
+
+    # Etc
+    "Metadata_Name": ('textList', ['Metadata_Name', 'text()']),
+    "Metadata_Version": ('textList', ['Metadata_Version', 'text()']),
+    "DIF_Creation_Date": ('textList', ['DIF_Creation_Date', 'text()']),
+    "Last_DIF_Revision_Date": ('textList', ['Last_DIF_Revision_Date', 'text()']),
+    "Private": ('textList', ['Private', 'text()']),
+    "ISO_Topic_Category": ('textList', ['ISO_Topic_Category', 'text()']),
+
+    # Missing...
+    #  "Distribution": ('textList', "//*[name()='Distribution']/text()"),
+    #  "Extended_Metadata": ('textList', "//*[name()='Extended_Metadata']/text()"),
+    #  "Location": ('textList', "//*[name()='Location']/text()"),
+    #  "Metadata_Association": ('textList', "//*[name()='Metadata_Association']/text()"),
+    #  "Metadata_Dates": ('textList', "//*[name()='Metadata_Dates']/text()"),
+    #  "Multimedia_Sample": ('textList', "//*[name()='Multimedia_Sample']/text()"),
+    #  "Originating_Metadata_Node": ('textList', "//*[name()='Originating_Metadata_Node']/text()"),
+    #  "Platform": ('textList', "//*[name()='Platform']/text()"),
+    #  "Product_Flag": ('textList', "//*[name()='Product_Flag']/text()"),
+    #  "Product_Level_Id": ('textList', "//*[name()='Product_Level_Id']/text()"),
+    #  "Quality": ('textList', "//*[name()='Quality']/text()"),
+    #  "Reference": ('textList', "//*[name()='Reference']/text()"),
+    #  "Science_Keywords": ('textList', "//*[name()='Science_Keywords']/text()"),
+    #  "Version_Description": ('textList', "//*[name()='Version_Description']/text()"),
+    #  "DIF_Revision_History": ('textList', "//*[name()='DIF_Revision_History']/text()"),
+    #  "Collection_Data_Type": ('textList', "//*[name()='Collection_Data_Type']/text()"),
+}
+
 dif_reader2 = MetadataReader(
-    fields={
-        # Basic info
-        "Entry_ID": _eval_builder('textList', ['Entry_ID', 'text()']),
-        "Entry_Title": _eval_builder('textList', ['Entry_Title', 'text()']),
-
-        # Dataset citation
-        "Data_Set_Citation/Dataset_Creator": _eval_builder('textList', ['Dataset_Creator', 'text()']),
-        "Data_Set_Citation/Dataset_Title": _eval_builder('textList', ['Dataset_Title', 'text()']),
-        "Data_Set_Citation/Dataset_Release_Date": _eval_builder('textList', ['Dataset_Release_Date', 'text()']),
-        "Data_Set_Citation/Dataset_Release_Place": _eval_builder('textList', ['Dataset_Release_Place', 'text()']),
-        "Data_Set_Citation/Dataset_Publisher": _eval_builder('textList', ['Dataset_Publisher', 'text()']),
-        "Data_Set_Citation/Version": _eval_builder('textList', ['Version', 'text()']),
-
-        # Personnel
-        "Personnel/Role": _eval_builder('textList', ['Personnel', 'Role', 'text()']),
-        "Personnel/First_Name": _eval_builder('textList', ['Personnel', 'First_Name', 'text()']),
-        "Personnel/Last_Name": _eval_builder('textList', ['Personnel', 'Last_Name', 'text()']),
-        "Personnel/Email": _eval_builder('textList', ['Personnel', 'Email', 'text()']),
-        "Personnel/Phone": _eval_builder('textList', ['Personnel', 'Phone', 'text()']),
-
-        # Personnel contact address
-        "Personnel/Contact_Address/Address": _eval_builder('textList', ['Personnel', 'Contact_Address', 'Address', 'text()']),
-        "Personnel/Contact_Address/City": _eval_builder('textList', ['Personnel', 'Contact_Address', 'City', 'text()']),
-        "Personnel/Contact_Address/Postal_Code": _eval_builder('textList', ['Personnel', 'Contact_Address', 'Postal_Code', 'text()']),
-        "Personnel/Contact_Address/Country": _eval_builder('textList', ['Personnel', 'Contact_Address', 'Country', 'text()']),
-
-        # Parameters
-        "Keyword": _eval_builder('textList', ['Keyword', 'text()']),
-
-        # Termporal coverage
-        "Temporal_Coverage/Start_Date": _eval_builder('textList', ['Temporal_Coverage', 'Start_Date', 'text()']),
-        "Temporal_Coverage/Stop_Date": _eval_builder('textList', ['Temporal_Coverage', 'Stop_Date', 'text()']),
-
-        # Data_Set_Progress
-        "Data_Set_Progress": _eval_builder('textList', ['Data_Set_Progress', 'text()']),
-
-        # Spatial_Coverage
-        "Spatial_Coverage/Southernmost_lat": _eval_builder('textList', ['Spatial_Coverage', 'Southernmost_Latitude', 'text()']),
-        "Spatial_Coverage/Northernmost_lat": _eval_builder('textList', ['Spatial_Coverage', 'Northernmost_Latitude', 'text()']),
-        "Spatial_Coverage/Westernmost_lon": _eval_builder('textList', ['Spatial_Coverage', 'Westernmost_Longitude', 'text()']),
-        "Spatial_Coverage/Easternmost_lon": _eval_builder('textList', ['Spatial_Coverage', 'Easternmost_Longitude', 'text()']),
-
-        # Project
-        "Project/Short_Name": _eval_builder('textList', ['Project', 'Short_Name', 'text()']),
-        "Project/Long_Name": _eval_builder('textList', ['Project', 'Long_Name', 'text()']),
-
-        "Access_Constraints": _eval_builder('textList', ['Access_Constraints', 'text()']),
-        "Use_Constraints": _eval_builder('textList', ['Use_Constraints', 'text()']),
-        "Data_Set_Language": _eval_builder('textList', ['Data_Set_Language', 'text()']),
-        "Originating_Center": _eval_builder('textList', ['Originating_Center', 'text()']),
-
-        # Data center
-        "Data_Center/Data_Center_Name/Short_Name": _eval_builder('textList', ['Data_Center', 'Data_Center_Name', 'Short_Name', 'text()']),
-        "Data_Center/Data_Center_Name/Long_Name": _eval_builder('textList', ['Data_Center', 'Data_Center_Name', 'Long_Name', 'text()']),
-        "Data_Center/Data_Center_URL": _eval_builder('textList', ['Data_Center', 'Data_Center_URL', 'text()']),
-        # Personnel
-        "Data_Center/Personnel/Role": _eval_builder('textList', ['Data_Center', 'Personnel', 'Role', 'text()']),
-        "Data_Center/Personnel/First_Name": _eval_builder('textList', ['Data_Center', 'Personnel', 'First_Name', 'text()']),
-        "Data_Center/Personnel/Last_Name": _eval_builder('textList', ['Data_Center', 'Personnel', 'Last_Name', 'text()']),
-        "Data_Center/Personnel/Email": _eval_builder('textList', ['Data_Center', 'Personnel', 'Email', 'text()']),
-        "Data_Center/Personnel/Phone": _eval_builder('textList', ['Data_Center', 'Personnel', 'Phone', 'text()']),
-        "Data_Center/Personnel/Contact_Address/Address": _eval_builder('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Address', 'text()']),
-        "Data_Center/Personnel/Contact_Address/City": _eval_builder('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'City', 'text()']),
-        "Data_Center/Personnel/Contact_Address/Postal_Code": _eval_builder('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Postal_Code', 'text()']),
-        "Data_Center/Personnel/Contact_Address/Country": _eval_builder('textList', ['Data_Center', 'Personnel', 'Contact_Address', 'Country', 'text()']),
-
-        # Reference
-        # TODO: Might contain 'Author' etc.
-        "Reference": _eval_builder('textList', ['Reference', 'text()']),
-
-        # Summary
-        "Summary/Abstract": _eval_builder('textList', ['Summary', 'Abstract', 'text()']),
-        
-        # Related URLs
-        "Related_URL/URL_Content_Type/Type": _eval_builder('textList', ['Related_URL', 'URL_Content_Type', 'Type', 'text()']),
-        # TODO: Add empty subtype if it does not exist.
-        #       How to connect Type and its corrent Subtype. The indices are currently wrong.
-        "Related_URL/URL_Content_Type/Subtype": _eval_builder('textList', ['Related_URL', 'URL_Content_Type', 'Subtype', 'text()']),
-        # TODO: Same for this
-        "Related_URL/URL": _eval_builder('textList', ['Related_URL', 'URL', 'text()']),
-        # TODO: Same for this
-        "Related_URL/Description": _eval_builder('textList', ['Related_URL', 'Description', 'text()']),
-
-        # IDN Node
-        # TODO: Usually not displayed to the user
-        "IDN_Node/Short_Name": _eval_builder('textList', ['IDN_Node', 'Short_Name', 'text()']),
-
-        # Etc
-        "Metadata_Name": _eval_builder('textList', ['Metadata_Name', 'text()']),
-        "Metadata_Version": _eval_builder('textList', ['Metadata_Version', 'text()']),
-        "DIF_Creation_Date": _eval_builder('textList', ['DIF_Creation_Date', 'text()']),
-        "Last_DIF_Revision_Date": _eval_builder('textList', ['Last_DIF_Revision_Date', 'text()']),
-        "Private": _eval_builder('textList', ['Private', 'text()']),
-        "ISO_Topic_Category": _eval_builder('textList', ['ISO_Topic_Category', 'text()']),
-
-        # Missing...
-        #  "Distribution": ('textList', "//*[name()='Distribution']/text()"),
-        #  "Extended_Metadata": ('textList', "//*[name()='Extended_Metadata']/text()"),
-        #  "Location": ('textList', "//*[name()='Location']/text()"),
-        #  "Metadata_Association": ('textList', "//*[name()='Metadata_Association']/text()"),
-        #  "Metadata_Dates": ('textList', "//*[name()='Metadata_Dates']/text()"),
-        #  "Multimedia_Sample": ('textList', "//*[name()='Multimedia_Sample']/text()"),
-        #  "Originating_Metadata_Node": ('textList', "//*[name()='Originating_Metadata_Node']/text()"),
-        #  "Platform": ('textList', "//*[name()='Platform']/text()"),
-        #  "Product_Flag": ('textList', "//*[name()='Product_Flag']/text()"),
-        #  "Product_Level_Id": ('textList', "//*[name()='Product_Level_Id']/text()"),
-        #  "Quality": ('textList', "//*[name()='Quality']/text()"),
-        #  "Reference": ('textList', "//*[name()='Reference']/text()"),
-        #  "Science_Keywords": ('textList', "//*[name()='Science_Keywords']/text()"),
-        #  "Version_Description": ('textList', "//*[name()='Version_Description']/text()"),
-        #  "DIF_Revision_History": ('textList', "//*[name()='DIF_Revision_History']/text()"),
-        #  "Collection_Data_Type": ('textList', "//*[name()='Collection_Data_Type']/text()"),
-    },
+    fields=dict(
+        (field_name, _eval_builder(field_type, elms))
+        for field_name, (field_type, elms) in dif_fields.items()
+    ),
     namespaces={
         'dif': 'https://gcmd.nasa.gov/Aboutus/xml/dif/'
     }
 )
+
+# Drop-in replacement for dif_reader2 which parses a record in one pass
+dif_tree_reader = TreeWalkReader(dif_fields)
@@ -0,0 +1,294 @@
+"""
+Timing and throughput metrics of the harvester.
+
+Counters and latency histograms are kept per source in the process.
+They are exported as a Prometheus text file (e.g. for the textfile
+collector of the node exporter) or sent to statsd, see configure.
+
+Metrics are disabled by default. Disabled, a counter is a flag check
+and a timer a shared object which does nothing.
+"""
+import atexit
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'ckanext_oaipmh'
+
+# upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_exporter = None
+_configured = False
+
+
+def configure(config):
+    """Enables the metrics according to the CKAN config:
+
+        ckanext.oaipmh.metrics = prometheus
+        ckanext.oaipmh.metrics.file = /var/lib/ckan/oaipmh-%(pid)s.prom
+        ckanext.oaipmh.metrics.interval = 10
+
+    writes the metrics to the file at most every `interval` seconds
+    (%(pid)s is replaced, every consumer process needs its own file),
+
+        ckanext.oaipmh.metrics = statsd
+        ckanext.oaipmh.metrics.statsd = localhost:8125
+
+    sends every count and timing to statsd. Only the first call of a
+    process has an effect.
+    """
+    global enabled, _exporter, _configured
+    if _configured:
+        return
+    _configured = True
+    backend = config.get('ckanext.oaipmh.metrics')
+    if backend == 'prometheus':
+        path = config.get(
+            'ckanext.oaipmh.metrics.file',
+            os.path.join(tempfile.gettempdir(), 'ckanext-oaipmh-%(pid)s.prom')
+        )
+        _exporter = PrometheusFile(
+            path % {'pid': os.getpid()},
+            float(config.get('ckanext.oaipmh.metrics.interval', 10))
+        )
+        atexit.register(_exporter.write)
+    elif backend == 'statsd':
+        host, _, port = config.get(
+            'ckanext.oaipmh.metrics.statsd',
+            'localhost:8125'
+        ).partition(':')
+        _exporter = Statsd(host, int(port or 8125))
+    elif backend:
+        log.warning('Unknown metrics backend: %s' % backend)
+        return
+    enabled = _exporter is not None
+
+
+def count(name, source, value=1):
+    """Adds `value` to the counter `name` of the source"""
+    if not enabled:
+        return
+    key = (name, source)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _exporter.count(name, source, value)
+
+
+def observe(name, source, seconds):
+    """Adds a duration to the histogram `name` of the source"""
+    if not enabled:
+        return
+    key = (name, source)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+    _exporter.timing(name, source, seconds)
+
+
+def timer(name, source):
+    """Returns a context manager which observes the time spent in it
+
+        with metrics.timer('get_record', source_id):
+            ...
+    """
+    if not enabled:
+        return _null_timer
+    return Timer(name, source)
+
+
+def flush():
+    """Exports the metrics if it is time to. It is called after every
+    record: without metrics it returns at once, the Prometheus file is
+    only written every `interval` seconds.
+    """
+    if enabled:
+        _exporter.flush()
+
+
+def snapshot():
+    """Returns copies of the counters and histograms, keyed by
+    (name, source)
+    """
+    with _lock:
+        return dict(_counters), dict(
+            (key, histogram.copy()) for key, histogram in _histograms.items()
+        )
+
+
+def reset():
+    """Disables the metrics and drops the collected values"""
+    global enabled, _exporter, _configured
+    enabled = False
+    _exporter = None
+    _configured = False
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.buckets = list(self.buckets)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+
+class Timer(object):
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, self.source, time.time() - self.start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class TimedRegistry(object):
+    """Wraps a metadata registry and observes the time the readers
+    take as the histogram 'parse' of the source
+    """
+    def __init__(self, registry, source):
+        self._registry = registry
+        self._source = source
+
+    def registerReader(self, metadata_prefix, reader):
+        self._registry.registerReader(metadata_prefix, reader)
+
+    def hasReader(self, metadata_prefix):
+        return self._registry.hasReader(metadata_prefix)
+
+    def readMetadata(self, metadata_prefix, element):
+        with timer('parse', self._source):
+            return self._registry.readMetadata(metadata_prefix, element)
+
+
+class PrometheusFile(object):
+    """Writes all metrics in the Prometheus text format"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._written = 0
+
+    def count(self, name, source, value):
+        pass
+
+    def timing(self, name, source, seconds):
+        pass
+
+    def flush(self):
+        if time.time() - self._written >= self.interval:
+            self.write()
+
+    def write(self):
+        self._written = time.time()
+        tmp_path = '%s.tmp' % self.path
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(prometheus_text())
+            # replaced at once, the collector never reads half a file
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            log.exception('Could not write the metrics to %s' % self.path)
+
+
+def prometheus_text():
+    counters, histograms = snapshot()
+    lines = []
+    for name in sorted(set(name for name, _ in counters)):
+        metric = '%s_%s_total' % (PREFIX, name)
+        lines.append('# TYPE %s counter' % metric)
+        for (counter, source), value in sorted(counters.items()):
+            if counter == name:
+                lines.append('%s{source="%s"} %s' % (metric, source, value))
+    for name in sorted(set(name for name, _ in histograms)):
+        metric = '%s_%s_seconds' % (PREFIX, name)
+        lines.append('# TYPE %s histogram' % metric)
+        for (histogram_name, source), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, value in zip(BUCKETS, histogram.buckets):
+                cumulative += value
+                lines.append('%s_bucket{source="%s",le="%s"} %s'
+                             % (metric, source, bound, cumulative))
+            lines.append('%s_bucket{source="%s",le="+Inf"} %s'
+                         % (metric, source, histogram.count))
+            lines.append('%s_sum{source="%s"} %s'
+                         % (metric, source, histogram.sum))
+            lines.append('%s_count{source="%s"} %s'
+                         % (metric, source, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class Statsd(object):
+    """Sends every count and timing to statsd (over UDP)"""
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def count(self, name, source, value):
+        self._send('%s:%s|c' % (self._key(name, source), value))
+
+    def timing(self, name, source, seconds):
+        self._send('%s:%.3f|ms' % (self._key(name, source), seconds * 1000))
+
+    def flush(self):
+        pass
+
+    def _key(self, name, source):
+        return '%s.%s.%s' % (PREFIX, re.sub(r'[^\w-]', '_', source), name)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            # metrics must not break the harvest
+            pass
@@ -0,0 +1,237 @@
+"""
+Gathering a repository in partitions (one per set or per date window)
+which are listed in parallel.
+
+Every partition is its own chain of list requests with its own
+resumption tokens. The pages of all partitions are handed to the
+calling thread, which is the only one touching the database.
+"""
+import datetime
+import logging
+import Queue
+import sys
+import threading
+
+from oaipmh import error
+
+import listing
+
+log = logging.getLogger(__name__)
+
+
+def set_partitions(client, args, allowed_sets=None):
+    """Returns the list arguments of one partition per set.
+
+    If `allowed_sets` is given only these sets are listed. Allowed sets
+    missing from ListSets are logged; if none of them is in ListSets,
+    they are all listed anyway (ListSets may leave sets out). A subset
+    ('a:b') is left out if its parent set ('a') is listed, its records
+    are part of the parent set. If the repository has no sets, `args`
+    is the only partition.
+    """
+    try:
+        specs = set(spec for spec, _, _ in client.listSets())
+    except error.NoSetHierarchyError:
+        return [args]
+    if allowed_sets is not None:
+        allowed_sets = set(allowed_sets)
+        missing = allowed_sets - specs
+        if missing:
+            log.warning(
+                'The sets %s are not in the ListSets response'
+                % ', '.join(sorted(missing))
+            )
+        if missing == allowed_sets:
+            specs = allowed_sets
+        else:
+            specs &= allowed_sets
+    if not specs:
+        return [args]
+
+    partitions = []
+    for spec in sorted(specs):
+        parts = spec.split(':')
+        if any(':'.join(parts[:i]) in specs for i in range(1, len(parts))):
+            continue
+        partitions.append(dict(args, set=spec))
+    return partitions
+
+
+def date_partitions(args, start, end, count, day_granularity=False):
+    """Returns the list arguments of `count` date windows from `start`
+    to `end`, see date_windows.
+    """
+    return [
+        dict(args, from_=from_, until=until)
+        for from_, until in date_windows(start, end, count, day_granularity)
+    ]
+
+
+def date_windows(start, end, count, day_granularity=False):
+    """Splits the datestamps from `start` to `end` into `count` windows
+    of about the same length, as (from, until) tuples.
+
+    Like the from and until arguments the windows include their
+    bounds, so a window ends one second (or one day) before the next
+    one starts. There are fewer windows if the range is too short.
+    """
+    if day_granularity:
+        unit = datetime.timedelta(days=1)
+        start = datetime.datetime(start.year, start.month, start.day)
+        end = datetime.datetime(end.year, end.month, end.day)
+    else:
+        unit = datetime.timedelta(seconds=1)
+        start = start.replace(microsecond=0)
+        end = end.replace(microsecond=0)
+    end = max(start, end)
+    units = int(_seconds(end - start) // _seconds(unit)) + 1
+    count = max(1, min(count, units))
+    return [
+        (start + unit * (units * i // count),
+         start + unit * (units * (i + 1) // count - 1))
+        for i in range(count)
+    ]
+
+
+def _seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds
+
+
+def date_splitter(max_size, day_granularity=False):
+    """Returns a split function for list_partitions, which halves the
+    date window of a partition with more than `max_size` records.
+    """
+    def split(args, page):
+        size = page.complete_list_size
+        if size is None or size <= max_size:
+            return None
+        windows = date_windows(
+            args['from_'],
+            args['until'],
+            2,
+            day_granularity
+        )
+        if len(windows) < 2:
+            return None
+        return [dict(args, from_=from_, until=until)
+                for from_, until in windows]
+    return split
+
+
+def list_partitions(client, verb, partitions, workers, retries=0,
+                    split=None):
+    """Yields the pages of the list requests of all partitions.
+
+    The partitions are listed by up to `workers` threads, the pages are
+    yielded in the calling thread in the order they arrive, with their
+    records read into a list. A failing partition is resumed at its
+    last page up to `retries` times (an expired resumption token
+    restarts the partition). Other errors are raised here and stop
+    the workers.
+
+    If given, `split(args, page)` is called with the first page of
+    every partition. If it returns smaller partitions, these are
+    listed instead of the partition.
+    """
+    tasks = Queue.Queue()
+    for args in partitions:
+        tasks.put(args)
+    results = Queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+
+    threads = [
+        threading.Thread(
+            target=_work,
+            args=(client, verb, retries, split, tasks, results, stop)
+        )
+        for _ in range(workers if split else min(workers, len(partitions)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            kind, value = results.get()
+            if kind == 'page':
+                yield value
+            elif kind == 'done':
+                running -= 1
+            else:
+                raise value[0], value[1], value[2]
+    finally:
+        stop.set()
+
+
+def _work(client, verb, retries, split, tasks, results, stop):
+    try:
+        while not stop.is_set():
+            try:
+                args = tasks.get(timeout=0.1)
+            except Queue.Empty:
+                # done unless another worker may still split a partition
+                if tasks.unfinished_tasks == 0:
+                    break
+                continue
+            if not _list_pages(client, verb, args, retries, split, tasks,
+                               results, stop):
+                return
+            tasks.task_done()
+    except Exception:
+        _put(results, ('error', sys.exc_info()), stop)
+        return
+    _put(results, ('done', None), stop)
+
+
+def _list_pages(client, verb, args, retries, split, tasks, results, stop):
+    """Puts the pages of a partition into `results`, or its parts into
+    `tasks` if it is split on its first page. Returns False if the
+    listing was stopped.
+    """
+    first = True
+    for page in _list_partition(client, verb, args, retries):
+        if first and split is not None:
+            parts = split(args, page)
+            if parts:
+                for part in parts:
+                    tasks.put(part)
+                return True
+        first = False
+        if not _put(results, ('page', page), stop):
+            return False
+    return True
+
+
+def _put(results, item, stop):
+    # waits for room in the queue unless the listing was stopped
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _list_partition(client, verb, args, retries):
+    token = None
+    while True:
+        try:
+            for page in listing.list_pages(client, verb, args, token):
+                page.records = list(page.records)
+                yield page
+                token = page.token
+            return
+        except error.NoRecordsMatchError:
+            return
+        except Exception, e:
+            if retries <= 0:
+                raise
+            retries -= 1
+            if isinstance(e, error.BadResumptionTokenError):
+                token = None
+            log.warning(
+                'Listing of partition %s failed, retrying' % args,
+                exc_info=True
+            )
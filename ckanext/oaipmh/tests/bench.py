@@ -0,0 +1,553 @@
+"""
+Benchmarks of the harvester against the synthetic repository of
+server.py:
+
+    python -m ckanext.oaipmh.tests.bench [--records 2000]
+        [--page-size 100] [--format dif] [--latency 0] [--error-rate 0]
+        [--compress] [--only requests/] [--timeout 600]
+        [--save baselines.json] [--compare baselines.json]
+
+The readers are measured on a page of records of every format. The
+requests/ benchmarks measure the requests the stages send, parsed and
+converted to the content of the harvest objects (ListIdentifiers /
+ListRecords of the gather stage, GetRecord of the fetch stage),
+mapping/ measures building the package dicts of the import stage.
+
+The stages/ benchmarks run gather_stage, fetch_stage and import_stage
+of the harvester on the harvest objects of one job. The database
+session and the CKAN actions are mocked and the packages are not
+saved, so the code of the stages is measured (batching, content
+encoding and hashing, package dicts) but not the database. mapping/
+and stages/ need CKAN and ckanext-harvest, they are skipped without.
+
+Every benchmark runs in its own process, so its peak memory (max RSS)
+is measured on its own. The results can be saved as JSON baselines;
+with --compare the exit status is 1 if a benchmark is slower (or uses
+more memory) than its baseline by more than --tolerance.
+"""
+import json
+import multiprocessing
+import optparse
+import resource
+import sys
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import mock
+from lxml import etree
+from oaipmh.metadata import MetadataRegistry
+
+from ckanext.oaipmh import codec, listing, transport
+from ckanext.oaipmh.metadata import (
+    oai_dc_reader, oai_ddi_reader, dif_reader2, dif_tree_reader
+)
+from ckanext.oaipmh.tests.server import Repository, Server
+
+READERS = [
+    ('oai_dc', 'oai_dc', oai_dc_reader),
+    ('oai_ddi', 'oai_ddi', oai_ddi_reader),
+    ('dif_xpath', 'dif', dif_reader2),
+    ('dif_tree', 'dif', dif_tree_reader),
+]
+
+NAMESPACES = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+
+def bench_reader(options, url, reader_name):
+    prefix, reader = [(p, r) for n, p, r in READERS if n == reader_name][0]
+    repository = Repository(prefix, options.records, options.records)
+    tree = etree.fromstring(repository.respond({
+        'verb': 'ListRecords',
+        'metadataPrefix': prefix,
+    }))
+    elements = tree.xpath('//oai:metadata', namespaces=NAMESPACES)
+    start = time.time()
+    for element in elements:
+        reader(element).getMap()
+    return len(elements), time.time() - start
+
+
+def bench_list_identifiers(options, url):
+    client = _client(options, url)
+    start = time.time()
+    count = 0
+    for page in listing.list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': options.format}):
+        for header, _ in page.records:
+            count += 1
+    return count, time.time() - start
+
+
+def bench_list_records(options, url):
+    client = _client(options, url)
+    start = time.time()
+    count = 0
+    for page in listing.list_pages(
+            client,
+            'ListRecords',
+            {'metadataPrefix': options.format}):
+        for header, metadata in page.records:
+            _record_content(header, metadata)
+            count += 1
+    return count, time.time() - start
+
+
+def bench_get_record(options, url, concurrency=1):
+    client = _client(options, url)
+    repository = Repository(options.format, options.records)
+    identifiers = [repository.identifier(i) for i in range(options.records)]
+
+    def get_record(identifier):
+        header, metadata, _ = client.getRecord(
+            identifier=identifier,
+            metadataPrefix=options.format
+        )
+        return _record_content(header, metadata)
+
+    start = time.time()
+    if concurrency > 1:
+        pool = ThreadPool(concurrency)
+        try:
+            pool.map(get_record, identifiers)
+        finally:
+            pool.close()
+    else:
+        for identifier in identifiers:
+            get_record(identifier)
+    return len(identifiers), time.time() - start
+
+
+def bench_package_dict(options, url):
+    try:
+        from ckanext.oaipmh.harvester import OaipmhHarvester
+    except ImportError:
+        return None
+
+    class Source(object):
+        id = 'bench'
+        config = json.dumps({'metadata_prefix': options.format})
+
+    class HarvestObject(object):
+        source = Source()
+
+        def __init__(self, guid, content):
+            self.guid = guid
+            self.content = content
+
+    class BenchHarvester(OaipmhHarvester):
+        # the lookups of the database are left out
+
+        def _get_job_context(self, harvest_object):
+            return {
+                'job_id': 'bench',
+                'profile': self._get_profile(Source),
+                'user': 'harvest',
+                'owner_org': None,
+            }
+
+        def _find_or_create_groups(self, groups, context):
+            return []
+
+    harvester = BenchHarvester()
+    harvester._get_profile(Source)
+    repository = Repository(options.format, options.records, options.records)
+    tree = etree.fromstring(repository.respond({
+        'verb': 'ListRecords',
+        'metadataPrefix': options.format,
+    }))
+    registry = harvester.profile.registry
+    objects = []
+    for record in tree.xpath('//oai:record', namespaces=NAMESPACES):
+        header, metadata = listing._build_record(
+            record,
+            NAMESPACES,
+            registry,
+            options.format
+        )
+        objects.append(HarvestObject(
+            header.identifier(),
+            harvester._get_record_content(header, metadata)
+        ))
+
+    start = time.time()
+    for harvest_object in objects:
+        harvester._get_package_dict(harvest_object)
+    return len(objects), time.time() - start
+
+
+def bench_gather(options, url, harvest_mode='list_identifiers'):
+    stages = _stages(options, url, {'harvest_mode': harvest_mode})
+    if stages is None:
+        return None
+    harvester, job, session = stages
+    start = time.time()
+    harvest_obj_ids = harvester.gather_stage(job)
+    return len(harvest_obj_ids), time.time() - start
+
+
+def bench_fetch(options, url, concurrency=1):
+    stages = _stages(options, url, {'max_concurrent_requests': concurrency})
+    if stages is None:
+        return None
+    harvester, job, session = stages
+    harvest_objects = _gathered(harvester, job, session)
+    start = time.time()
+    while session.waiting:
+        harvester.fetch_stage(session.waiting.pop(0))
+    seconds = time.time() - start
+    return len([o for o in harvest_objects if o.content]), seconds
+
+
+def bench_import(options, url, batch_import=False):
+    stages = _stages(options, url, {
+        'harvest_mode': 'list_records',
+        'batch_import': batch_import,
+    })
+    if stages is None:
+        return None
+    harvester, job, session = stages
+    harvest_objects = _gathered(harvester, job, session)
+    start = time.time()
+    while session.waiting:
+        harvester.import_stage(session.waiting.pop(0))
+    seconds = time.time() - start
+    return len([o for o in harvest_objects if o.current]), seconds
+
+
+def _stages(options, url, config):
+    """Returns a harvester, a harvest job of the repository at `url`
+    and the session standing in for the database, or None without
+    CKAN. The patches stay for the rest of the benchmark process.
+    """
+    try:
+        from ckanext.harvest.model import (
+            HarvestJob, HarvestObject, HarvestSource
+        )
+        from ckanext.oaipmh import harvester
+    except ImportError:
+        return None
+
+    class BenchHarvester(harvester.OaipmhHarvester):
+        # saving the packages is not measured, an error fails the
+        # benchmark
+
+        def _create_or_update_package(self, package_dict, harvest_object):
+            harvest_object.package_id = package_dict['id']
+            harvest_object.current = True
+            return True
+
+        def _save_object_error(self, message, obj, stage=u'Fetch',
+                               line=None):
+            raise AssertionError('%s of %s: %s' % (stage, obj.guid, message))
+
+        def _save_gather_error(self, message, job):
+            raise AssertionError(message)
+
+    session = Session(HarvestObject)
+    mock.patch.multiple(
+        harvester,
+        Session=session,
+        get_action=_get_action,
+        search=mock.MagicMock()
+    ).start()
+    mock.patch.object(HarvestObject, 'save', lambda self: None).start()
+
+    config = dict(config, metadata_prefix=options.format)
+    source = HarvestSource(
+        id='bench',
+        url=url,
+        type='oai_pmh',
+        config=json.dumps(config)
+    )
+    job = HarvestJob(id='bench', source=source, source_id=source.id)
+    return BenchHarvester(), job, session
+
+
+def _gathered(harvester, job, session):
+    """Gathers the harvest objects of the job (not measured), which are
+    then waiting for the fetch and import stages
+    """
+    harvester.gather_stage(job)
+    harvest_objects = [
+        obj for obj in session.added
+        if isinstance(obj, session.object_class)
+    ]
+    for obj in harvest_objects:
+        # as ckanext-harvest does on insert
+        obj.source = job.source
+    session.waiting = list(harvest_objects)
+    return harvest_objects
+
+
+def _get_action(name):
+    # the actions the stages call (package_show of the source,
+    # group_show, package_delete) find what they look for
+    def action(context, data_dict):
+        return {'id': data_dict.get('id'), 'owner_org': None}
+    return action
+
+
+class Session(object):
+    """Stands in for the database session of the stages.
+
+    The objects added to it are kept. A query of harvest objects with a
+    limit (the batch of the fetch or the import stage) takes them from
+    the waiting objects, any other query finds nothing.
+    """
+    def __init__(self, object_class):
+        self.object_class = object_class
+        self.added = []
+        self.waiting = []
+
+    def __call__(self):
+        return self
+
+    def query(self, entity, *entities):
+        return Query(self, entity)
+
+    def take(self, count):
+        taken = self.waiting[:count]
+        del self.waiting[:count]
+        return taken
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    def begin_nested(self):
+        # the savepoint is committed or rolled back like the session
+        return self
+
+    def commit(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class Query(object):
+
+    def __init__(self, session, entity):
+        self._session = session
+        self._entity = entity
+        self._limit = None
+
+    def _chain(self, *args, **kwargs):
+        return self
+
+    filter = join = order_by = with_for_update = _chain
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def all(self):
+        if self._entity is self._session.object_class and self._limit:
+            return self._session.take(self._limit)
+        return []
+
+    def first(self):
+        return None
+
+    def scalar(self):
+        return False
+
+    def update(self, values, synchronize_session=None):
+        return 0
+
+
+def _client(options, url):
+    registry = MetadataRegistry()
+    for _, prefix, reader in READERS:
+        if reader is not dif_reader2:
+            registry.registerReader(prefix, reader)
+    client = transport.Client(url, registry, pool_size=8)
+    client._day_granularity = False
+    return client
+
+
+def _record_content(header, metadata):
+    # as OaipmhHarvester._get_record_content
+    content_dict = metadata.getMap()
+    content_dict['set_spec'] = header.setSpec()
+    content_dict['metadata_modified'] = header.datestamp().isoformat()
+    return codec.encode(content_dict)
+
+
+BENCHMARKS = [
+    ('reader/%s' % name, bench_reader, (name,)) for name, _, _ in READERS
+] + [
+    ('requests/list_identifiers', bench_list_identifiers, ()),
+    ('requests/list_records', bench_list_records, ()),
+    ('requests/get_record', bench_get_record, ()),
+    ('requests/get_record_concurrent', bench_get_record, (8,)),
+    ('mapping/package_dict', bench_package_dict, ()),
+    ('stages/gather', bench_gather, ()),
+    ('stages/gather_list_records', bench_gather, ('list_records',)),
+    ('stages/fetch', bench_fetch, ()),
+    ('stages/fetch_concurrent', bench_fetch, (8,)),
+    ('stages/import', bench_import, ()),
+    ('stages/import_batch', bench_import, (True,)),
+]
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def run(options, url, function, args):
+    """Runs a benchmark in a child process, returns its result or None
+    if it was skipped. Raises BenchmarkError if the benchmark failed or
+    took longer than --timeout seconds.
+    """
+    parent, child = multiprocessing.Pipe()
+
+    def target():
+        try:
+            result = function(options, url, *args)
+        except BaseException:
+            child.send(('error', traceback.format_exc()))
+            return
+        if result is not None:
+            records, seconds = result
+            result = {
+                'records': records,
+                'seconds': round(seconds, 4),
+                'records_per_second': round(records / max(seconds, 1e-9), 1),
+                # kilobytes on Linux
+                'peak_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss,
+            }
+        child.send(('result', result))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    deadline = time.time() + options.timeout
+    try:
+        while not parent.poll(1):
+            if not process.is_alive() and not parent.poll():
+                raise BenchmarkError(
+                    'exited with status %s' % process.exitcode
+                )
+            if time.time() > deadline:
+                raise BenchmarkError(
+                    'timed out after %ss' % options.timeout
+                )
+        status, result = parent.recv()
+    finally:
+        if process.is_alive() and not parent.poll():
+            process.terminate()
+        process.join()
+    if status == 'error':
+        raise BenchmarkError(result)
+    return result
+
+
+def compare(results, baselines, tolerance):
+    """Returns the regressions of the results against the baselines"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if not result or not baseline:
+            continue
+        if result['records_per_second'] < \
+                baseline['records_per_second'] * (1 - tolerance):
+            regressions.append('%s: %s records/s (baseline %s)' % (
+                name,
+                result['records_per_second'],
+                baseline['records_per_second']
+            ))
+        if result['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %s kB (baseline %s kB)' % (
+                name,
+                result['peak_rss_kb'],
+                baseline['peak_rss_kb']
+            ))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--records', type='int', default=2000)
+    parser.add_option('--page-size', type='int', default=100)
+    parser.add_option('--format', default='dif',
+                      help='metadata format of the stage benchmarks')
+    parser.add_option('--latency', type='float', default=0,
+                      help='delay of every response in seconds')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help='share of the requests answered with 503')
+    parser.add_option('--compress', action='store_true',
+                      help='compress the responses (gzip)')
+    parser.add_option('--only', help='run the benchmarks starting with this')
+    parser.add_option('--save', help='save the results to this file')
+    parser.add_option('--compare', help='compare with the baselines file')
+    parser.add_option('--tolerance', type='float', default=0.2)
+    parser.add_option('--timeout', type='float', default=600,
+                      help='seconds after which a benchmark is stopped')
+    options, _ = parser.parse_args(argv)
+
+    server = Server(
+        Repository(options.format, options.records, options.page_size),
+        latency=options.latency,
+        error_rate=options.error_rate,
+        compress=options.compress
+    )
+    url = server.start()
+    results = {}
+    failed = []
+    try:
+        for name, function, args in BENCHMARKS:
+            if options.only and not name.startswith(options.only):
+                continue
+            try:
+                result = run(options, url, function, args)
+            except BenchmarkError, e:
+                failed.append(name)
+                print '%-30s failed: %s' % (name, e)
+                continue
+            results[name] = result
+            if result is None:
+                print '%-30s skipped' % name
+            else:
+                print '%-30s %10.1f records/s %10d kB' % (
+                    name,
+                    result['records_per_second'],
+                    result['peak_rss_kb']
+                )
+    finally:
+        server.stop()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'options': {
+                    'records': options.records,
+                    'page_size': options.page_size,
+                    'format': options.format,
+                    'latency': options.latency,
+                    'error_rate': options.error_rate,
+                    'compress': options.compress,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baselines = json.load(f)['results']
+        regressions = compare(results, baselines, options.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            return 1
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,438 @@
+"""
+A synthetic OAI-PMH repository, served over HTTP from a thread of the
+test process.
+
+The repository generates `size` records in one of the metadata formats
+oai_dc, oai_ddi or dif. It supports all verbs, resumption tokens,
+sets and from/until, and can answer slowly (`latency`), with 503
+errors (`error_rate`) or compressed (`compress`). It is used by the tests and the benchmarks
+(see bench.py).
+"""
+import datetime
+import gzip
+import hashlib
+import math
+import random
+import threading
+import time
+import urlparse
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+
+RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="%s">
+<responseDate>2017-05-01T00:00:00Z</responseDate>
+<request>%%s</request>
+%%s
+</OAI-PMH>''' % OAI_NS
+
+DATESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+FORMATS = {
+    'oai_dc': ('http://www.openarchives.org/OAI/2.0/oai_dc.xsd',
+               'http://www.openarchives.org/OAI/2.0/oai_dc/'),
+    'oai_ddi': ('http://www.icpsr.umich.edu/DDI/Version2-0.xsd',
+                'http://www.icpsr.umich.edu/DDI'),
+    'dif': ('http://gcmd.nasa.gov/Aboutus/xml/dif/dif.xsd',
+            'http://gcmd.gsfc.nasa.gov/Aboutus/xml/dif/'),
+}
+
+
+class Repository(object):
+    """Generates the records and the responses of the repository.
+
+    Record i has the identifier oai:example.com:<i>, its datestamp is
+    `start` plus i minutes, it is in the set sets[i % len(sets)] and
+    deleted if `deleted_every` divides i + 1.
+    """
+    def __init__(self, metadata_prefix='dif', size=100, page_size=50,
+                 sets=(), start=datetime.datetime(2017, 1, 1),
+                 deleted_every=0):
+        if metadata_prefix not in FORMATS:
+            raise ValueError('Unknown format: %s' % metadata_prefix)
+        self.metadata_prefix = metadata_prefix
+        self.size = size
+        self.page_size = page_size
+        self.sets = list(sets)
+        self.start = start
+        self.deleted_every = deleted_every
+
+    def identifier(self, i):
+        return 'oai:example.com:%06d' % i
+
+    def datestamp(self, i):
+        return self.start + datetime.timedelta(minutes=i)
+
+    def set_spec(self, i):
+        if self.sets:
+            return self.sets[i % len(self.sets)]
+        return None
+
+    def is_deleted(self, i):
+        return bool(self.deleted_every) and (i + 1) % self.deleted_every == 0
+
+    def respond(self, args):
+        """Returns the response body to the request arguments"""
+        verb = args.get('verb')
+        handler = getattr(self, '_' + (verb or ''), None)
+        if verb is None or handler is None:
+            return self._response(args, _error('badVerb'))
+        return self._response(args, handler(args))
+
+    def _response(self, args, body):
+        return RESPONSE % (
+            escape(' '.join('%s=%s' % item for item in sorted(args.items()))),
+            body
+        )
+
+    def _Identify(self, args):
+        return '''<Identify>
+<repositoryName>Synthetic repository</repositoryName>
+<baseURL>http://127.0.0.1/oai</baseURL>
+<protocolVersion>2.0</protocolVersion>
+<adminEmail>admin@example.com</adminEmail>
+<earliestDatestamp>%s</earliestDatestamp>
+<deletedRecord>%s</deletedRecord>
+<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>
+</Identify>''' % (
+            self.start.strftime(DATESTAMP_FORMAT),
+            'persistent' if self.deleted_every else 'no'
+        )
+
+    def _ListMetadataFormats(self, args):
+        schema, namespace = FORMATS[self.metadata_prefix]
+        return '''<ListMetadataFormats><metadataFormat>
+<metadataPrefix>%s</metadataPrefix>
+<schema>%s</schema>
+<metadataNamespace>%s</metadataNamespace>
+</metadataFormat></ListMetadataFormats>''' % (
+            self.metadata_prefix, schema, namespace
+        )
+
+    def _ListSets(self, args):
+        if not self.sets:
+            return _error('noSetHierarchy')
+        return '<ListSets>%s</ListSets>' % ''.join(
+            '<set><setSpec>%s</setSpec><setName>%s</setName></set>'
+            % (spec, spec) for spec in self.sets
+        )
+
+    def _GetRecord(self, args):
+        if args.get('metadataPrefix') != self.metadata_prefix:
+            return _error('cannotDisseminateFormat')
+        try:
+            i = int(args.get('identifier', '').rsplit(':', 1)[1])
+        except (IndexError, ValueError):
+            i = -1
+        if not 0 <= i < self.size:
+            return _error('idDoesNotExist')
+        return '<GetRecord>%s</GetRecord>' % self.record(i)
+
+    def _ListIdentifiers(self, args):
+        return self._list(args, 'ListIdentifiers', self.header)
+
+    def _ListRecords(self, args):
+        return self._list(args, 'ListRecords', self.record)
+
+    def _list(self, args, verb, build):
+        if 'resumptionToken' in args:
+            try:
+                offset, query = args['resumptionToken'].split('|', 1)
+                offset = int(offset)
+                query = dict(urlparse.parse_qsl(query))
+            except ValueError:
+                return _error('badResumptionToken')
+        else:
+            offset, query = 0, dict(
+                (key, args[key])
+                for key in ('metadataPrefix', 'set', 'from', 'until')
+                if key in args
+            )
+        if query.get('metadataPrefix') != self.metadata_prefix:
+            return _error('cannotDisseminateFormat')
+
+        selected = self._select(query)
+        if not selected:
+            return _error('noRecordsMatch')
+        page = [
+            selected[j]
+            for j in xrange(offset, min(offset + self.page_size, len(selected)))
+        ]
+        token = ''
+        if offset + self.page_size < len(selected):
+            token = '%s|%s' % (
+                offset + self.page_size,
+                '&'.join('%s=%s' % item for item in sorted(query.items()))
+            )
+        if token or offset:
+            page_token = (
+                '<resumptionToken completeListSize="%s" cursor="%s">%s'
+                '</resumptionToken>' % (len(selected), offset, escape(token))
+            )
+        else:
+            page_token = ''
+        return '<%s>%s%s</%s>' % (
+            verb, ''.join(build(i) for i in page), page_token, verb
+        )
+
+    def _select(self, query):
+        # the indexes of the selected records, computed instead of
+        # filtered as the datestamps grow with the index
+        first, last = 0, self.size - 1
+        from_ = _parse_datestamp(query.get('from'), start=True)
+        if from_:
+            first = max(first, int(math.ceil(_minutes(from_ - self.start))))
+        until = _parse_datestamp(query.get('until'), start=False)
+        if until:
+            last = min(last, int(math.floor(_minutes(until - self.start))))
+        step = 1
+        if 'set' in query:
+            if query['set'] not in self.sets:
+                return xrange(0)
+            step = len(self.sets)
+            first += (self.sets.index(query['set']) - first) % step
+        if first > last:
+            return xrange(0)
+        return xrange(first, last + 1, step)
+
+    def header(self, i):
+        set_spec = self.set_spec(i)
+        return '<header%s><identifier>%s</identifier>' \
+            '<datestamp>%s</datestamp>%s</header>' % (
+                ' status="deleted"' if self.is_deleted(i) else '',
+                self.identifier(i),
+                self.datestamp(i).strftime(DATESTAMP_FORMAT),
+                '<setSpec>%s</setSpec>' % set_spec if set_spec else ''
+            )
+
+    def record(self, i):
+        if self.is_deleted(i):
+            return '<record>%s</record>' % self.header(i)
+        metadata = getattr(self, '_' + self.metadata_prefix)(i)
+        return '<record>%s<metadata>%s</metadata></record>' % (
+            self.header(i), metadata
+        )
+
+    def _oai_dc(self, i):
+        return '''<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>Synthetic dataset %(i)s</dc:title>
+<dc:creator>Creator %(i)s</dc:creator>
+<dc:subject>subject-%(a)s</dc:subject>
+<dc:subject>subject-%(b)s</dc:subject>
+<dc:description>Description of the synthetic dataset %(i)s, %(text)s</dc:description>
+<dc:publisher>Publisher %(a)s</dc:publisher>
+<dc:date>2016-01-01</dc:date>
+<dc:type>Dataset</dc:type>
+<dc:format>text/csv</dc:format>
+<dc:identifier>http://example.com/dataset/%(i)s</dc:identifier>
+<dc:language>en</dc:language>
+<dc:rights>CC-BY 4.0</dc:rights>
+</oai_dc:dc>''' % _values(i)
+
+    def _oai_ddi(self, i):
+        return '''<oai_ddi:codeBook xmlns="" xmlns:oai_ddi="http://www.icpsr.umich.edu/DDI" xml:lang="en">
+<stdyDscr>
+<citation>
+<titlStmt><titl>Synthetic study %(i)s</titl><IDNo>http://example.com/study/%(i)s</IDNo></titlStmt>
+<rspStmt><AuthEnty>Author %(i)s</AuthEnty></rspStmt>
+<prodStmt><prodDate>2016-01-01</prodDate></prodStmt>
+<distStmt><contact>Publisher %(a)s</contact></distStmt>
+<serStmt><serName>Series %(b)s</serName></serStmt>
+</citation>
+<stdyInfo>
+<subject><keyword>keyword-%(a)s</keyword><keyword>keyword-%(b)s</keyword></subject>
+<abstract>Abstract of the synthetic study %(i)s, %(text)s</abstract>
+<sumDscr><timePrd>2015</timePrd><geogCover>Norway</geogCover><dataKind>Survey</dataKind></sumDscr>
+</stdyInfo>
+</stdyDscr>
+<fileDscr><fileType>SPSS</fileType></fileDscr>
+</oai_ddi:codeBook>''' % _values(i)
+
+    def _dif(self, i):
+        return '''<DIF xmlns="http://gcmd.gsfc.nasa.gov/Aboutus/xml/dif/">
+<Entry_ID>%(i)s</Entry_ID>
+<Entry_Title>Synthetic dataset %(i)s</Entry_Title>
+<Data_Set_Citation>
+<Dataset_Creator>Creator %(i)s</Dataset_Creator>
+<Dataset_Title>Synthetic dataset %(i)s</Dataset_Title>
+<Dataset_Publisher>Publisher %(a)s</Dataset_Publisher>
+</Data_Set_Citation>
+<Personnel>
+<Role>Investigator</Role>
+<First_Name>First</First_Name>
+<Last_Name>Last %(i)s</Last_Name>
+<Email>person%(i)s@example.com</Email>
+</Personnel>
+<Keyword>keyword-%(a)s</Keyword>
+<Keyword>keyword-%(b)s</Keyword>
+<Temporal_Coverage><Start_Date>2010-01-01</Start_Date><Stop_Date>2016-12-31</Stop_Date></Temporal_Coverage>
+<Spatial_Coverage>
+<Southernmost_Latitude>60.0</Southernmost_Latitude>
+<Northernmost_Latitude>90.0</Northernmost_Latitude>
+<Westernmost_Longitude>-180.0</Westernmost_Longitude>
+<Easternmost_Longitude>180.0</Easternmost_Longitude>
+</Spatial_Coverage>
+<Use_Constraints>CC-BY 4.0</Use_Constraints>
+<Data_Center>
+<Data_Center_Name><Short_Name>DC-%(a)s</Short_Name></Data_Center_Name>
+<Personnel><Role>Data Center Contact</Role><Email>data@example.com</Email></Personnel>
+</Data_Center>
+<Summary><Abstract>Abstract of the synthetic dataset %(i)s, %(text)s</Abstract></Summary>
+<Related_URL>
+<URL_Content_Type><Type>GET DATA</Type></URL_Content_Type>
+<URL>http://example.com/dataset/%(i)s</URL>
+<Description>Data access</Description>
+</Related_URL>
+<Metadata_Name>CEOS IDN DIF</Metadata_Name>
+<Metadata_Version>9.7</Metadata_Version>
+<Private>False</Private>
+</DIF>''' % _values(i)
+
+
+def _values(i):
+    return {
+        'i': i,
+        'a': i % 7,
+        'b': i % 13,
+        'text': 'lorem ipsum dolor sit amet ' * 4,
+    }
+
+
+def _minutes(delta):
+    return (delta.days * 24 * 60 * 60 + delta.seconds) / 60.0
+
+
+def _error(code):
+    return '<error code="%s">%s</error>' % (code, code)
+
+
+def _parse_datestamp(value, start):
+    if not value:
+        return None
+    if len(value) == 10:
+        day = datetime.datetime.strptime(value, '%Y-%m-%d')
+        if start:
+            return day
+        return day + datetime.timedelta(days=1, seconds=-1)
+    return datetime.datetime.strptime(value, DATESTAMP_FORMAT)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # no delayed responses on the kept-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        self._respond(parts.query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._respond(self.rfile.read(length))
+
+    def _respond(self, query):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.random.random() < server.error_rate
+        if server.latency:
+            time.sleep(server.latency)
+        if fail:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        args = dict(urlparse.parse_qsl(query))
+        body = server.repository.respond(args)
+        headers = [('Content-Type', 'text/xml; charset=utf-8')]
+        if args.get('verb') in ('Identify', 'ListMetadataFormats'):
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                with server.lock:
+                    server.not_modified += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            headers.append(('ETag', etag))
+        if server.compress:
+            encoding = _encoding(self.headers.get('Accept-Encoding', ''))
+            if encoding:
+                body = _compress(body, encoding)
+                headers.append(('Content-Encoding', encoding))
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _encoding(accept_encoding):
+    accepted = [e.split(';')[0].strip() for e in accept_encoding.split(',')]
+    for encoding in ('gzip', 'deflate'):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _compress(body, encoding):
+    if encoding == 'deflate':
+        return zlib.compress(body)
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """Serves a repository at http://127.0.0.1:<port>/oai.
+
+    `latency` is the delay of every response in seconds, `error_rate`
+    the share of the requests which are answered with a 503 error. If
+    `compress` is set responses are compressed if the client accepts
+    gzip or deflate. Identify and ListMetadataFormats responses have an
+    ETag and are answered with 304 when it matches.
+    """
+    daemon_threads = True
+    # write responses in one piece
+    wbufsize = -1
+
+    def __init__(self, repository, latency=0, error_rate=0, seed=0,
+                 compress=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.repository = repository
+        self.latency = latency
+        self.error_rate = error_rate
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/oai' % self.server_port
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.serve_forever,
+            kwargs={'poll_interval': 0.05}
+        )
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,121 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+from oaipmh.metadata import MetadataRegistry
+
+from ckanext.oaipmh import transport
+from ckanext.oaipmh.archive import Archive, RawRecordRegistry, read_record
+from ckanext.oaipmh.listing import list_pages
+from ckanext.oaipmh.metadata import dif_tree_reader
+from ckanext.oaipmh.tests.server import Repository, Server
+
+RECORD = '<record><metadata>%s</metadata></record>'
+
+
+class TestArchive(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_and_get(self):
+        archive = Archive(self.path)
+        assert archive.put('source', 'oai:1', '2017-01-01', RECORD % 1)
+        archive.put('source', 'oai:2', '2017-01-01', RECORD % 2)
+        archive.put('other', 'oai:1', '2017-01-01', RECORD % 3)
+
+        assert_equal(archive.get('source', 'oai:1'), RECORD % 1)
+        assert_equal(archive.get('other', 'oai:1'), RECORD % 3)
+        assert_equal(archive.get('source', 'oai:3'), None)
+        assert_equal(
+            sorted(archive.records('source')),
+            [('oai:1', '2017-01-01'), ('oai:2', '2017-01-01')]
+        )
+
+    def test_latest_version(self):
+        archive = Archive(self.path)
+        archive.put('source', 'oai:1', datetime.datetime(2017, 1, 1), 'a')
+        archive.put('source', 'oai:1', datetime.datetime(2017, 2, 1), 'b')
+        # the same version is not written again
+        assert not archive.put(
+            'source', 'oai:1', datetime.datetime(2017, 2, 1), 'b')
+
+        assert_equal(archive.get('source', 'oai:1'), 'b')
+        assert_equal(len(archive), 1)
+
+    def test_reopen(self):
+        archive = Archive(self.path)
+        archive.put('source', 'oai:1', '2017-01-01', 'a')
+        archive.put('source', 'oai:1', '2017-01-02', 'b')
+        archive.close()
+
+        archive = Archive(self.path)
+        assert_equal(archive.get('source', 'oai:1'), 'b')
+
+    def test_other_writer(self):
+        reader = Archive(self.path)
+        writer = Archive(self.path)
+        writer.put('source', 'oai:1', '2017-01-01', 'a')
+
+        assert_equal(reader.get('source', 'oai:1'), 'a')
+
+    def test_compact(self):
+        archive = Archive(self.path, segment_size=1024)
+        for version in range(5):
+            for i in range(10):
+                archive.put(
+                    'source',
+                    'oai:%s' % i,
+                    '2017-01-0%s' % (version + 1),
+                    os.urandom(100)
+                )
+        latest = dict(
+            (i, archive.get('source', 'oai:%s' % i)) for i in range(10)
+        )
+        segments = len(archive._segments())
+
+        assert archive.compact() > 0
+        assert len(archive._segments()) < segments
+        for i in range(10):
+            assert_equal(archive.get('source', 'oai:%s' % i), latest[i])
+        # the index was rewritten
+        assert_equal(
+            dict((i, Archive(self.path).get('source', 'oai:%s' % i))
+                 for i in range(10)),
+            latest
+        )
+
+
+class TestRawRecords(object):
+
+    def setup(self):
+        self.server = Server(Repository('dif', size=3))
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_raw_record_is_read_again(self):
+        registry = MetadataRegistry()
+        registry.registerReader('dif', dif_tree_reader)
+        client = transport.Client(
+            self.server.start(),
+            RawRecordRegistry(registry)
+        )
+        pages = list_pages(client, 'ListRecords', {'metadataPrefix': 'dif'})
+        records = [record for page in pages for record in page.records]
+
+        assert_equal(len(records), 3)
+        for header, metadata in records:
+            archived_header, archived_metadata = read_record(
+                metadata.raw,
+                registry,
+                'dif'
+            )
+            assert_equal(archived_header.identifier(), header.identifier())
+            assert_equal(archived_header.datestamp(), header.datestamp())
+            assert_equal(archived_metadata.getMap(), metadata.getMap())
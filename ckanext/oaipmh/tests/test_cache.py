@@ -0,0 +1,43 @@
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.oaipmh.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache()
+        cache.set('group', 'id-1')
+
+        assert_equal(cache.get('group'), 'id-1')
+        assert_equal(cache.get('other'), None)
+        assert_equal(cache.get('other', 'default'), 'default')
+
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert_equal(len(cache), 2)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+
+        assert_equal(cache.get('a'), None)
+
+    def test_pop(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+
+        assert_equal(cache.pop('a'), 1)
+        assert_equal(cache.pop('a'), None)
+        assert_equal(cache.get('a'), None)
@@ -0,0 +1,62 @@
+import json
+import os
+
+from lxml import etree
+from nose.tools import assert_equal
+
+from ckanext.oaipmh import codec
+from ckanext.oaipmh.metadata import dif_tree_reader, list_fields
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+NAMESPACES = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+
+def _dif_content():
+    tree = etree.parse(os.path.join(DATA_DIR, 'dif_record.xml'))
+    element = tree.xpath('//oai:record/oai:metadata', namespaces=NAMESPACES)[0]
+    content = dif_tree_reader(element).getMap()
+    content['set_spec'] = []
+    content['metadata_modified'] = '2017-04-01T12:00:00'
+    return content
+
+
+class TestCodec(object):
+
+    def test_round_trip(self):
+        content = _dif_content()
+        fields = list_fields(dif_tree_reader) + ['set_spec']
+        decoded = codec.decode(codec.encode(content), fields)
+
+        assert_equal(decoded, content)
+
+    def test_empty_fields_are_dropped(self):
+        content = _dif_content()
+        decoded = codec.decode(codec.encode(content))
+
+        assert 'set_spec' not in decoded
+        assert_equal(
+            sorted(decoded),
+            sorted(key for key, value in content.items() if value != [])
+        )
+
+    def test_encoding_is_stable(self):
+        content = _dif_content()
+        reordered = dict(reversed(list(content.items())))
+
+        assert_equal(codec.encode(content), codec.encode(reordered))
+
+    def test_encoding_is_smaller(self):
+        content = _dif_content()
+
+        assert len(codec.encode(content)) < len(json.dumps(content)) / 2
+
+    def test_plain_json(self):
+        content = {'Entry_ID': [u'0001'], 'Entry_Title': []}
+        decoded = codec.decode(json.dumps(content), ['Entry_Title', 'Parameters'])
+
+        assert_equal(decoded, {
+            'Entry_ID': [u'0001'],
+            'Entry_Title': [],
+            'Parameters': [],
+        })
@@ -0,0 +1,227 @@
+import datetime
+import os
+
+from nose.tools import assert_equal, assert_raises
+
+from oaipmh.client import BaseClient
+from oaipmh import error
+from oaipmh.metadata import MetadataRegistry
+
+from ckanext.oaipmh.listing import list_pages, parse_record
+from ckanext.oaipmh.metadata import dif_tree_reader
+from ckanext.oaipmh.tests.server import Repository
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+PAGE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2017-05-01T00:00:00Z</responseDate>
+  <request verb="ListIdentifiers">http://example.com/oai</request>
+  <ListIdentifiers>
+    %s
+    %s
+  </ListIdentifiers>
+</OAI-PMH>'''
+
+HEADER = '''<header>
+  <identifier>%s</identifier>
+  <datestamp>2017-04-01T12:00:00Z</datestamp>
+  <setSpec>test</setSpec>
+</header>'''
+
+TOKEN = ('<resumptionToken cursor="%s" completeListSize="5">%s'
+         '</resumptionToken>')
+
+ERROR = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2017-05-01T00:00:00Z</responseDate>
+  <request>http://example.com/oai</request>
+  <error code="badResumptionToken">expired</error>
+</OAI-PMH>'''
+
+
+class PagedClient(BaseClient):
+    '''
+    Client answering with three pages of identifiers
+    '''
+    def __init__(self):
+        BaseClient.__init__(self)
+        self.requests = []
+        self.pages = {
+            None: PAGE % (
+                HEADER % 'oai:1' + HEADER % 'oai:2',
+                TOKEN % (0, 'page-2')),
+            'page-2': PAGE % (
+                HEADER % 'oai:3' + HEADER % 'oai:4',
+                TOKEN % (2, 'page-3')),
+            'page-3': PAGE % (HEADER % 'oai:5', TOKEN % (4, '')),
+        }
+
+    def makeRequest(self, **kw):
+        self.requests.append(kw)
+        token = kw.get('resumptionToken')
+        if token not in self.pages:
+            return ERROR
+        return self.pages[token]
+
+
+class FileClient(BaseClient):
+    '''
+    Client answering with the content of a file of the test data
+    '''
+    def __init__(self, filename, registry):
+        BaseClient.__init__(self, registry)
+        self.filename = os.path.join(DATA_DIR, filename)
+
+    def makeRequest(self, **kw):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+
+class TestListPages(object):
+
+    def test_pages(self):
+        client = PagedClient()
+        pages = []
+        for page in list_pages(
+                client, 'ListIdentifiers', {'metadataPrefix': 'oai_dc'}):
+            records = list(page.records)
+            pages.append((page, records))
+
+        assert_equal(len(pages), 3)
+        page, records = pages[0]
+        assert_equal(
+            [header.identifier() for header, _ in records],
+            ['oai:1', 'oai:2']
+        )
+        assert_equal(records[0][1], None)
+        assert_equal(page.token, 'page-2')
+        assert_equal(page.count, 2)
+        assert_equal(pages[1][0].cursor, 2)
+        assert_equal(pages[1][0].complete_list_size, 5)
+        assert_equal(pages[2][0].token, None)
+
+    def test_unread_pages_are_parsed(self):
+        client = PagedClient()
+        pages = list(list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'}
+        ))
+
+        assert_equal(len(pages), 3)
+        assert_equal([page.count for page in pages], [2, 2, 1])
+        assert_equal(pages[0].datestamp, datetime.datetime(2017, 4, 1, 12))
+
+    def test_list_records(self):
+        registry = MetadataRegistry()
+        registry.registerReader('dif', dif_tree_reader)
+        client = FileClient('dif_page.xml', registry)
+        page = next(list_pages(client, 'ListRecords', {'metadataPrefix': 'dif'}))
+        records = [
+            (header.identifier(), header.isDeleted(),
+             metadata and metadata.getField('Entry_ID'))
+            for header, metadata in page.records
+        ]
+
+        assert_equal(records, [
+            ('oai:example.com:0002', False, [u'0002']),
+            ('oai:example.com:0003', False, []),
+            ('oai:example.com:0004', True, None),
+        ])
+        assert_equal(page.token, None)
+
+    def test_no_records_match(self):
+        client = PagedClient()
+        client.pages[None] = ERROR.replace(
+            'badResumptionToken',
+            'noRecordsMatch'
+        )
+        pages = list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'}
+        )
+
+        assert_raises(error.NoRecordsMatchError, next, pages)
+
+    def test_resume_with_token(self):
+        client = PagedClient()
+        pages = list(list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'},
+            token='page-3'
+        ))
+
+        assert_equal(len(pages), 1)
+        assert_equal(client.requests, [
+            {'verb': 'ListIdentifiers', 'resumptionToken': 'page-3'}
+        ])
+
+    def test_expired_token(self):
+        client = PagedClient()
+        pages = list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'},
+            token='expired'
+        )
+
+        assert_raises(error.BadResumptionTokenError, list, pages)
+
+    def test_request_arguments(self):
+        client = PagedClient()
+        client._day_granularity = True
+        list(list_pages(client, 'ListIdentifiers', {
+            'metadataPrefix': 'oai_dc',
+            'set': 'test',
+            'from_': datetime.datetime(2017, 4, 1, 12, 30),
+        }))
+
+        assert_equal(client.requests[0], {
+            'verb': 'ListIdentifiers',
+            'metadataPrefix': 'oai_dc',
+            'set': 'test',
+            'from': '2017-04-01',
+        })
+
+
+class TestParseRecord(object):
+
+    def setup(self):
+        self.repository = Repository('dif', size=3)
+        self.registry = MetadataRegistry()
+        self.registry.registerReader('dif', dif_tree_reader)
+
+    def test_record(self):
+        header, metadata = parse_record(
+            self.repository.respond({
+                'verb': 'GetRecord',
+                'identifier': 'oai:example.com:000001',
+                'metadataPrefix': 'dif',
+            }),
+            self.registry,
+            'dif'
+        )
+
+        assert_equal(header.identifier(), 'oai:example.com:000001')
+        assert_equal(
+            metadata.getField('Entry_Title'),
+            [u'Synthetic dataset 1']
+        )
+
+    def test_error(self):
+        xml = self.repository.respond({
+            'verb': 'GetRecord',
+            'identifier': 'oai:example.com:000003',
+            'metadataPrefix': 'dif',
+        })
+
+        assert_raises(
+            error.IdDoesNotExistError,
+            parse_record,
+            xml,
+            self.registry,
+            'dif'
+        )
@@ -0,0 +1,94 @@
+import os
+
+from lxml import etree
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.oaipmh import metadata
+from ckanext.oaipmh.metadata import (
+    MetadataReader, TreeWalkReader, dif_reader2, dif_tree_reader
+)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+NAMESPACES = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+
+def _metadata_elements(filename):
+    tree = etree.parse(os.path.join(DATA_DIR, filename))
+    return tree.xpath('//oai:record/oai:metadata', namespaces=NAMESPACES)
+
+
+class TestMetadataReader(object):
+
+    def test_dif_record(self):
+        element = _metadata_elements('dif_record.xml')[0]
+        content = dif_reader2(element).getMap()
+
+        assert_equal(content['Entry_Title'], [u'Sea ice concentration, Arctic'])
+        assert_equal(
+            content['Personnel/Email'],
+            [u'kari@example.com', u'ola@example.com', u'data@example.com']
+        )
+        assert_equal(content['Data_Center/Personnel/Email'],
+                     [u'data@example.com'])
+        assert_equal(content['Summary/Abstract'],
+                     [u'Daily sea ice concentration', u' of the Arctic.'])
+        assert_equal(content['Related_URL/URL_Content_Type/Subtype'],
+                     [u'THREDDS DATA SERVER (TDS)'])
+        assert_equal(content['Private'], [u'False'])
+
+    def test_records_of_a_page_are_separated(self):
+        first, second = _metadata_elements('dif_page.xml')
+
+        assert_equal(dif_reader2(first).getField('Entry_ID'), [u'0002'])
+        assert_equal(dif_reader2(second).getField('Entry_ID'), [])
+
+    def test_unknown_field_type(self):
+        assert_raises(
+            metadata.Error,
+            MetadataReader,
+            fields={'title': ('float', 'title/text()')}
+        )
+
+
+class TestTreeWalkReader(object):
+
+    def test_parity_with_xpath_reader(self):
+        elements = (_metadata_elements('dif_record.xml') +
+                    _metadata_elements('dif_page.xml'))
+        for element in elements:
+            assert_equal(
+                dif_tree_reader(element).getMap(),
+                dif_reader2(element).getMap()
+            )
+
+    def test_dif_page(self):
+        first, second = _metadata_elements('dif_page.xml')
+        content = dif_tree_reader(first).getMap()
+
+        assert_equal(content['Entry_Title'],
+                     [u'Nested and <escaped> title'])
+        assert_equal(
+            content['Personnel/Email'],
+            [u'first@example.com', u'second', u'part@example.com',
+             u'nested@example.com']
+        )
+        assert_equal(content['Summary/Abstract'],
+                     [u'Outer', u'inner', u'tail'])
+        # name() contains the prefix of the element
+        content = dif_tree_reader(second).getMap()
+        assert_equal(content['Entry_ID'], [])
+        assert_equal(content['Entry_Title'], [u'Unqualified title'])
+
+    def test_values_are_unicode(self):
+        element = _metadata_elements('dif_record.xml')[0]
+        for values in dif_tree_reader(element).getMap().values():
+            for value in values:
+                assert isinstance(value, metadata.text_type), value
+
+    def test_unsupported_path(self):
+        assert_raises(
+            metadata.Error,
+            TreeWalkReader,
+            {'Entry_ID': ('textList', ['Entry_ID', '@id'])}
+        )
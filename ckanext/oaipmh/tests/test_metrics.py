@@ -0,0 +1,100 @@
+import os
+import shutil
+import socket
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.oaipmh import metrics
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        metrics.reset()
+        shutil.rmtree(self.dir)
+
+    def _configure_prometheus(self):
+        metrics.configure({
+            'ckanext.oaipmh.metrics': 'prometheus',
+            'ckanext.oaipmh.metrics.file':
+                os.path.join(self.dir, 'oaipmh-%(pid)s.prom'),
+            'ckanext.oaipmh.metrics.interval': '0',
+        })
+        return os.path.join(self.dir, 'oaipmh-%s.prom' % os.getpid())
+
+    def test_disabled(self):
+        metrics.configure({})
+        metrics.count('fetched', 'source')
+        with metrics.timer('get_record', 'source'):
+            pass
+        metrics.flush()
+
+        assert not metrics.enabled
+        assert_equal(metrics.snapshot(), ({}, {}))
+
+    def test_counters_and_histograms(self):
+        self._configure_prometheus()
+        metrics.count('fetched', 'a')
+        metrics.count('fetched', 'a', 2)
+        metrics.count('fetched', 'b')
+        metrics.observe('get_record', 'a', 0.003)
+        metrics.observe('get_record', 'a', 3)
+        with metrics.timer('get_record', 'a'):
+            pass
+
+        counters, histograms = metrics.snapshot()
+        assert_equal(counters, {('fetched', 'a'): 3, ('fetched', 'b'): 1})
+        histogram = histograms[('get_record', 'a')]
+        assert_equal(histogram.count, 3)
+        assert_equal(histogram.buckets[0], 1)   # the timer, <= 0.001
+        assert_equal(histogram.buckets[1], 1)   # <= 0.005
+        assert_equal(histogram.buckets[9], 1)   # <= 5
+
+    def test_prometheus_file(self):
+        path = self._configure_prometheus()
+        metrics.count('imported', 'a', 5)
+        metrics.observe('commit', 'a', 0.2)
+        metrics.flush()
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert 'ckanext_oaipmh_imported_total{source="a"} 5' in lines
+        assert '# TYPE ckanext_oaipmh_commit_seconds histogram' in lines
+        assert 'ckanext_oaipmh_commit_seconds_bucket{source="a",le="0.1"} 0' \
+            in lines
+        assert 'ckanext_oaipmh_commit_seconds_bucket{source="a",le="0.25"} 1' \
+            in lines
+        assert 'ckanext_oaipmh_commit_seconds_count{source="a"} 1' in lines
+
+    def test_prometheus_file_interval(self):
+        path = self._configure_prometheus()
+        metrics._exporter.interval = 60
+        metrics.flush()
+        os.remove(path)
+        metrics.count('imported', 'a')
+        metrics.flush()
+
+        assert not os.path.exists(path)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            metrics.configure({
+                'ckanext.oaipmh.metrics': 'statsd',
+                'ckanext.oaipmh.metrics.statsd':
+                    '127.0.0.1:%s' % server.getsockname()[1],
+            })
+            metrics.count('fetched', 'source-1', 2)
+
+            assert_equal(
+                server.recv(1024),
+                'ckanext_oaipmh.source-1.fetched:2|c'
+            )
+        finally:
+            server.close()
@@ -0,0 +1,263 @@
+import datetime
+import threading
+
+from nose.tools import assert_equal, assert_raises
+
+from oaipmh.client import BaseClient
+from oaipmh import error
+
+from ckanext.oaipmh.partition import (
+    date_partitions, date_splitter, date_windows, list_partitions,
+    set_partitions
+)
+
+RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2017-05-01T00:00:00Z</responseDate>
+  <request>http://example.com/oai</request>
+  %s
+</OAI-PMH>'''
+
+HEADER = '''<header>
+  <identifier>%s</identifier>
+  <datestamp>%s</datestamp>
+</header>'''
+
+SET = '<set><setSpec>%s</setSpec><setName>%s</setName></set>'
+
+TOKEN = '<resumptionToken>%s</resumptionToken>'
+
+ERROR = '<error code="%s">error</error>'
+
+
+class SetClient(BaseClient):
+    '''
+    Client of a repository with the sets a, a:b and c, listing the
+    identifiers of every set in pages of one identifier
+    '''
+    identifiers = {
+        'a': ['oai:1', 'oai:2'],
+        'a:b': ['oai:2'],
+        'c': ['oai:2', 'oai:3', 'oai:4'],
+    }
+
+    def __init__(self):
+        BaseClient.__init__(self)
+        self.requests = []
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def makeRequest(self, **kw):
+        with self._lock:
+            self.requests.append(kw)
+        if kw['verb'] == 'ListSets':
+            sets = ''.join(
+                SET % (spec, spec) for spec in sorted(self.identifiers)
+            )
+            return RESPONSE % ('<ListSets>%s</ListSets>' % sets)
+
+        if 'resumptionToken' in kw:
+            spec, index = kw['resumptionToken'].split('|')
+            index = int(index)
+        else:
+            spec, index = kw['set'], 0
+        if self.failures.get((spec, index)):
+            self.failures[(spec, index)] -= 1
+            raise IOError('connection reset')
+        identifiers = self.identifiers[spec]
+        token = ''
+        if index + 1 < len(identifiers):
+            token = '%s|%s' % (spec, index + 1)
+        return RESPONSE % (
+            '<ListIdentifiers>%s%s</ListIdentifiers>'
+            % (HEADER % (identifiers[index], '2017-04-01T12:00:00Z'),
+               TOKEN % token)
+        )
+
+
+class DateClient(BaseClient):
+    '''
+    Client of a repository with one record per day in January 2017,
+    listing the identifiers in pages of five identifiers
+    '''
+    def __init__(self):
+        BaseClient.__init__(self)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def makeRequest(self, **kw):
+        with self._lock:
+            self.requests.append(kw)
+        if 'resumptionToken' in kw:
+            from_, until, index = kw['resumptionToken'].split('|')
+            index = int(index)
+        else:
+            from_, until, index = kw['from'], kw['until'], 0
+        datestamps = [
+            '2017-01-%02dT00:00:00Z' % day for day in range(1, 32)
+        ]
+        datestamps = [d for d in datestamps if from_ <= d <= until]
+        if not datestamps:
+            return RESPONSE % (ERROR % 'noRecordsMatch')
+        token = ''
+        if index + 5 < len(datestamps):
+            token = '%s|%s|%s' % (from_, until, index + 5)
+        headers = ''.join(
+            HEADER % ('oai:' + d[:10], d) for d in datestamps[index:index + 5]
+        )
+        return RESPONSE % (
+            '<ListIdentifiers>%s<resumptionToken completeListSize="%s">'
+            '%s</resumptionToken></ListIdentifiers>'
+            % (headers, len(datestamps), token)
+        )
+
+
+class NoSetsClient(BaseClient):
+
+    def makeRequest(self, **kw):
+        return RESPONSE % (ERROR % 'noSetHierarchy')
+
+
+def _identifiers(pages):
+    return sorted(
+        header.identifier() for page in pages for header, _ in page.records
+    )
+
+
+class TestSetPartitions(object):
+
+    def test_subsets_are_left_out(self):
+        partitions = set_partitions(SetClient(), {'metadataPrefix': 'dif'})
+
+        assert_equal(partitions, [
+            {'metadataPrefix': 'dif', 'set': 'a'},
+            {'metadataPrefix': 'dif', 'set': 'c'},
+        ])
+
+    def test_allowed_sets(self):
+        partitions = set_partitions(
+            SetClient(),
+            {'metadataPrefix': 'dif'},
+            ['a:b', 'c', 'unknown']
+        )
+
+        assert_equal([args['set'] for args in partitions], ['a:b', 'c'])
+
+    def test_unknown_allowed_sets(self):
+        partitions = set_partitions(
+            SetClient(),
+            {'metadataPrefix': 'dif'},
+            ['unknown']
+        )
+
+        assert_equal(partitions, [
+            {'metadataPrefix': 'dif', 'set': 'unknown'},
+        ])
+
+    def test_no_sets(self):
+        args = {'metadataPrefix': 'dif'}
+
+        assert_equal(set_partitions(NoSetsClient(), args), [args])
+
+
+class TestListPartitions(object):
+
+    def test_all_partitions_are_listed(self):
+        client = SetClient()
+        partitions = [{'metadataPrefix': 'dif', 'set': spec}
+                      for spec in sorted(client.identifiers)]
+        pages = list(list_partitions(
+            client, 'ListIdentifiers', partitions, workers=2))
+
+        assert_equal(len(pages), 6)
+        assert_equal(
+            _identifiers(pages),
+            ['oai:1', 'oai:2', 'oai:2', 'oai:2', 'oai:3', 'oai:4']
+        )
+
+    def test_failed_partition_is_resumed(self):
+        client = SetClient()
+        client.failures[('c', 2)] = 1
+        pages = list(list_partitions(
+            client,
+            'ListIdentifiers',
+            [{'metadataPrefix': 'dif', 'set': 'c'}],
+            workers=2,
+            retries=1
+        ))
+
+        assert_equal(_identifiers(pages), ['oai:2', 'oai:3', 'oai:4'])
+        # the failed page was requested again with its token
+        assert_equal(
+            [kw.get('resumptionToken') for kw in client.requests],
+            [None, 'c|1', 'c|2', 'c|2']
+        )
+
+    def test_errors_are_raised(self):
+        client = SetClient()
+        client.failures[('c', 1)] = 2
+        pages = list_partitions(
+            client,
+            'ListIdentifiers',
+            [{'metadataPrefix': 'dif', 'set': 'c'}],
+            workers=1,
+            retries=1
+        )
+
+        assert_raises(IOError, list, pages)
+
+
+class TestDatePartitions(object):
+
+    def test_windows(self):
+        windows = date_windows(
+            datetime.datetime(2017, 1, 1),
+            datetime.datetime(2017, 1, 1, 0, 0, 9),
+            3
+        )
+
+        assert_equal(windows, [
+            (datetime.datetime(2017, 1, 1, 0, 0, 0),
+             datetime.datetime(2017, 1, 1, 0, 0, 2)),
+            (datetime.datetime(2017, 1, 1, 0, 0, 3),
+             datetime.datetime(2017, 1, 1, 0, 0, 5)),
+            (datetime.datetime(2017, 1, 1, 0, 0, 6),
+             datetime.datetime(2017, 1, 1, 0, 0, 9)),
+        ])
+
+    def test_day_windows(self):
+        windows = date_windows(
+            datetime.datetime(2017, 1, 1, 12, 30),
+            datetime.datetime(2017, 1, 2, 8),
+            5,
+            day_granularity=True
+        )
+
+        assert_equal(windows, [
+            (datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 1)),
+            (datetime.datetime(2017, 1, 2), datetime.datetime(2017, 1, 2)),
+        ])
+
+    def test_large_windows_are_split(self):
+        client = DateClient()
+        client._day_granularity = False
+        partitions = date_partitions(
+            {'metadataPrefix': 'dif'},
+            datetime.datetime(2016, 12, 1),
+            datetime.datetime(2017, 2, 1),
+            2
+        )
+        pages = list(list_partitions(
+            client,
+            'ListIdentifiers',
+            partitions,
+            workers=4,
+            split=date_splitter(5)
+        ))
+
+        identifiers = _identifiers(pages)
+        assert_equal(len(identifiers), 31)
+        assert_equal(len(set(identifiers)), 31)
+        # no window which was listed had more than five records
+        for page in pages:
+            assert page.complete_list_size <= 5, page.complete_list_size
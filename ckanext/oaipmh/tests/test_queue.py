@@ -8,6 +8,8 @@ import ckan.logic as logic
 from ckan import model
 from pprint import pprint
 
+from ckanext.oaipmh.tests.server import Repository, Server
+
 
 class TestOaipmhHarvester(OaipmhHarvester):
 
@@ -25,9 +27,12 @@ class TestHarvestQueue(object):
     @classmethod
     def setup_class(cls):
         harvest_model.setup()
+        cls.server = Server(Repository('dif', size=10, page_size=4))
+        cls.server.start()
 
     @classmethod
     def teardown_class(cls):
+        cls.server.stop()
         model.repo.rebuild_db()
 
     def test_01_basic_harvester(self):
@@ -49,7 +54,7 @@ class TestHarvestQueue(object):
         source_dict = {
             'title': 'Test Source',
             'name': 'test-source',
-            'url': 'http://www.lidata.eu/oaiprovider/',
+            'url': self.server.url,
             'source_type': 'test',
         }
 
@@ -86,4 +91,7 @@ class TestHarvestQueue(object):
         # reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
         # queue.fetch_callback(consumer_fetch, *reply)
 
-        assert 1 == 2
+        harvest_objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == job_id) \
+            .all()
+        assert len(harvest_objects) == 10, len(harvest_objects)
@@ -0,0 +1,142 @@
+import datetime
+
+from nose.tools import assert_equal, assert_raises
+
+from oaipmh import error
+from oaipmh.metadata import MetadataRegistry
+
+from ckanext.oaipmh import transport
+from ckanext.oaipmh.listing import list_pages
+from ckanext.oaipmh.metadata import (
+    oai_dc_reader, oai_ddi_reader, dif_tree_reader
+)
+from ckanext.oaipmh.tests.server import Repository, Server
+
+
+class TestServer(object):
+
+    def setup(self):
+        self.servers = []
+
+    def _start(self, repository, **kw):
+        self.server = Server(repository, **kw)
+        self.servers.append(self.server)
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        registry.registerReader('oai_ddi', oai_ddi_reader)
+        registry.registerReader('dif', dif_tree_reader)
+        return transport.Client(self.server.start(), registry)
+
+    def teardown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_list_identifiers(self):
+        client = self._start(Repository(size=25, page_size=10))
+        pages = list(list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'dif'}
+        ))
+
+        assert_equal([page.count for page in pages], [10, 10, 5])
+        assert_equal(pages[0].complete_list_size, 25)
+
+    def test_sets_and_dates(self):
+        client = self._start(Repository(size=25, sets=['a', 'b']))
+        client._day_granularity = False
+        pages = list_pages(client, 'ListIdentifiers', {
+            'metadataPrefix': 'dif',
+            'set': 'b',
+            'from_': datetime.datetime(2017, 1, 1, 0, 10),
+            'until': datetime.datetime(2017, 1, 1, 0, 15),
+        })
+        identifiers = [header.identifier()
+                       for page in pages for header, _ in page.records]
+
+        assert_equal(identifiers, [
+            'oai:example.com:000011',
+            'oai:example.com:000013',
+            'oai:example.com:000015',
+        ])
+
+    def test_records_of_all_formats(self):
+        for prefix, field in [('oai_dc', 'title'),
+                              ('oai_ddi', 'title'),
+                              ('dif', 'Entry_Title')]:
+            client = self._start(Repository(prefix, size=3))
+            header, metadata, _ = client.getRecord(
+                identifier='oai:example.com:000002',
+                metadataPrefix=prefix
+            )
+            assert_equal(metadata.getField(field), [u'Synthetic %s 2' % (
+                'study' if prefix == 'oai_ddi' else 'dataset')])
+
+    def test_deleted_records(self):
+        client = self._start(Repository(size=4, deleted_every=2))
+        records = list(client.listRecords(metadataPrefix='dif'))
+
+        assert_equal(
+            [header.isDeleted() for header, _, _ in records],
+            [False, True, False, True]
+        )
+
+    def test_compressed_responses(self):
+        client = self._start(Repository(size=20, page_size=20), compress=True)
+        records = list(client.listRecords(metadataPrefix='dif'))
+
+        assert_equal(len(records), 20)
+        assert client.wire_bytes * 5 < client.decoded_bytes, (
+            client.wire_bytes, client.decoded_bytes)
+
+    def test_streamed_pages(self):
+        client = self._start(Repository(size=200, page_size=200),
+                             compress=True)
+        body = client.streamRequest(verb='ListRecords', metadataPrefix='dif')
+        first = body.read(1024)
+        rest = body.read()
+        body.close()
+        body.close()
+
+        assert_equal(len(first), 1024)
+        assert first.startswith('<?xml')
+        assert rest.rstrip().endswith('</OAI-PMH>')
+        assert_equal(client.decoded_bytes, len(first) + len(rest))
+        assert client.wire_bytes * 5 < client.decoded_bytes, (
+            client.wire_bytes, client.decoded_bytes)
+
+        pages = list(list_pages(client, 'ListRecords', {
+            'metadataPrefix': 'dif'
+        }))
+        assert_equal(pages[0].count, 200)
+
+    def test_uncompressed_responses(self):
+        client = self._start(Repository(size=5))
+        list(client.listRecords(metadataPrefix='dif'))
+
+        assert_equal(client.wire_bytes, client.decoded_bytes)
+
+    def test_identify_is_revalidated(self):
+        client = self._start(Repository(size=3))
+        for _ in range(3):
+            assert_equal(
+                client.identify().repositoryName(),
+                'Synthetic repository'
+            )
+            client.listMetadataFormats()
+
+        assert_equal(self.server.requests, 6)
+        assert_equal(self.server.not_modified, 4)
+
+    def test_errors(self):
+        client = self._start(Repository(size=3), error_rate=0.5)
+        for _ in range(10):
+            client.identify()
+        assert self.server.requests > 10
+
+        assert_raises(
+            error.IdDoesNotExistError,
+            client.getRecord,
+            identifier='oai:example.com:000003',
+            metadataPrefix='dif'
+        )
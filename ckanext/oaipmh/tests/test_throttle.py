@@ -0,0 +1,80 @@
+import threading
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.oaipmh.throttle import Throttle, backoff
+
+
+class TestThrottle(object):
+
+    def test_failure_halves_the_limit(self):
+        throttle = Throttle(8)
+        throttle.success(1)
+        throttle.failure()
+        assert_equal(throttle.concurrency, 4)
+        # once per round trip
+        throttle.failure()
+        assert_equal(throttle.concurrency, 4)
+
+    def test_success_raises_the_limit(self):
+        throttle = Throttle(8)
+        throttle.failure()
+        # one per round of `limit` responses
+        for _ in range(5):
+            throttle.success(0.01)
+        assert_equal(throttle.concurrency, 5)
+        for _ in range(100):
+            throttle.success(0.01)
+        assert_equal(throttle.concurrency, 8)
+
+    def test_slowdown_lowers_the_limit(self):
+        throttle = Throttle(8)
+        for _ in range(5):
+            throttle.success(0.01)
+        for _ in range(10):
+            throttle.success(1)
+        assert throttle.concurrency < 8, throttle.concurrency
+
+    def test_not_adaptive(self):
+        throttle = Throttle(8, adaptive=False)
+        throttle.failure()
+        throttle.success(1)
+        assert_equal(throttle.concurrency, 8)
+
+    def test_concurrency_is_limited(self):
+        throttle = Throttle(2)
+        state = {'in_flight': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def request():
+            throttle.acquire()
+            try:
+                with lock:
+                    state['in_flight'] += 1
+                    state['max'] = max(state['max'], state['in_flight'])
+                time.sleep(0.01)
+                with lock:
+                    state['in_flight'] -= 1
+            finally:
+                throttle.release()
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(state['max'], 2)
+
+    def test_pause(self):
+        throttle = Throttle(2, adaptive=False)
+        throttle.failure(pause=0.2)
+        start = time.time()
+        throttle.acquire()
+        throttle.release()
+        assert time.time() - start >= 0.15
+
+    def test_backoff(self):
+        for attempt in range(10):
+            wait = backoff(1, attempt, 30)
+            assert 0 <= wait <= min(30, 2 ** attempt), (attempt, wait)
@@ -0,0 +1,163 @@
+import email.utils
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import requests
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.oaipmh import transport
+
+IDENTIFY = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2017-05-01T00:00:00Z</responseDate>
+  <request verb="Identify">http://localhost/oai</request>
+  <Identify>
+    <repositoryName>Test</repositoryName>
+    <baseURL>http://localhost/oai</baseURL>
+    <protocolVersion>2.0</protocolVersion>
+    <adminEmail>admin@example.com</adminEmail>
+    <earliestDatestamp>2017-01-01</earliestDatestamp>
+    <deletedRecord>no</deletedRecord>
+    <granularity>YYYY-MM-DD</granularity>
+  </Identify>
+</OAI-PMH>'''
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        if self.server.unavailable:
+            self.server.unavailable -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.server.failing:
+            self.server.failing -= 1
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(IDENTIFY)))
+        self.end_headers()
+        self.wfile.write(IDENTIFY)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    requests = 0
+    unavailable = 0
+    failing = 0
+
+
+class TestClient(object):
+
+    def setup(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%s/oai' % self.server.server_port
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        client = transport.Client(self.url)
+        for _ in range(5):
+            assert_equal(client.identify().repositoryName(), 'Test')
+
+        assert_equal(self.server.requests, 5)
+        assert_equal(self.server.connections, 1)
+
+    def test_http_get(self):
+        client = transport.Client(self.url, force_http_get=True)
+        assert_equal(client.identify().granularity(), 'YYYY-MM-DD')
+
+    def test_retry_after(self):
+        self.server.unavailable = 2
+        client = transport.Client(self.url)
+        assert_equal(client.identify().repositoryName(), 'Test')
+        assert_equal(self.server.requests, 3)
+
+    def test_transient_errors_are_retried(self):
+        self.server.failing = 2
+        client = transport.Client(self.url, backoff=0.01)
+        assert_equal(client.identify().repositoryName(), 'Test')
+        assert_equal(self.server.requests, 3)
+        # the failures lowered the concurrent requests
+        assert client.throttle.concurrency < transport.DEFAULT_POOL_SIZE
+
+    def test_retries_are_limited(self):
+        self.server.failing = 3
+        client = transport.Client(self.url, max_retries=2, backoff=0.01)
+        assert_raises(requests.HTTPError, client.identify)
+        assert_equal(self.server.requests, 3)
+
+    def test_cached_client(self):
+        created = []
+
+        def create_client():
+            created.append(transport.Client(self.url))
+            return created[-1]
+
+        first = transport.get_client(('test', self.url), create_client)
+        second = transport.get_client(('test', self.url), create_client)
+        assert first is second
+        assert_equal(len(created), 1)
+
+    def test_throttle_is_shared_by_host(self):
+        first = transport.Client(self.url)
+        second = transport.Client(self.url + '/other')
+        assert first.throttle is second.throttle
+        first.throttle.failure(pause=60)
+        assert second.throttle._resume_at > time.time()
+
+        other = transport.Client('http://localhost:1/oai')
+        assert other.throttle is not first.throttle
+
+
+class Response(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class TestRetryAfter(object):
+
+    def test_seconds(self):
+        assert_equal(transport._retry_after(Response({'Retry-After': '5'})), 5)
+
+    def test_date(self):
+        seconds = transport._retry_after(Response({
+            'Retry-After': email.utils.formatdate(time.time() + 60)
+        }))
+        assert 55 < seconds <= 60, seconds
+
+    def test_missing_or_invalid(self):
+        assert_equal(transport._retry_after(Response({})), None)
+        assert_equal(
+            transport._retry_after(Response({'Retry-After': 'soon'})),
+            None
+        )
@@ -0,0 +1,125 @@
+"""
+Adaptive limit of the concurrent requests to a provider.
+
+The limit is raised by one per round of successful requests (about
+`limit` responses) and halved when a request fails or the latency
+rises well above the lowest latency seen (AIMD, as in TCP congestion
+control). A provider is thus used at the rate it sustains.
+"""
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# weight of a new latency in the moving average
+LATENCY_WEIGHT = 0.2
+# the baseline latency follows a rising average this slowly
+BASELINE_DRIFT = 0.01
+# latency (relative to the baseline) above which the provider is
+# considered overloaded
+SLOWDOWN = 3.0
+# factor of the limit on failures and slowdowns
+DECREASE = 0.5
+
+
+class Throttle(object):
+    """Limits the concurrent requests to one provider.
+
+    At most `max_concurrency` requests are sent at a time. If
+    `adaptive` is set the limit moves between 1 and `max_concurrency`
+    according to the outcome of the requests, see success and failure.
+    Requests can be paused altogether, e.g. for a Retry-After.
+
+        throttle.acquire()
+        try:
+            ...
+        finally:
+            throttle.release()
+    """
+    def __init__(self, max_concurrency, adaptive=True):
+        self.max_concurrency = max(1, max_concurrency)
+        self.adaptive = adaptive
+        self.limit = float(self.max_concurrency)
+        self.latency = None
+        self.baseline = None
+        self._in_flight = 0
+        self._resume_at = 0
+        self._decreased_at = 0
+        self._condition = threading.Condition()
+
+    @property
+    def concurrency(self):
+        """The number of requests currently allowed at a time"""
+        return int(self.limit)
+
+    def acquire(self):
+        """Waits until a request may be sent"""
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.time()
+                if wait <= 0 and self._in_flight < self.concurrency:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def success(self, latency):
+        """Records a response which took `latency` seconds"""
+        with self._condition:
+            if self.latency is None:
+                self.latency = self.baseline = latency
+            else:
+                self.latency += LATENCY_WEIGHT * (latency - self.latency)
+                if self.latency < self.baseline:
+                    self.baseline = self.latency
+                else:
+                    self.baseline += \
+                        BASELINE_DRIFT * (self.latency - self.baseline)
+            if not self.adaptive:
+                return
+            if self.latency > SLOWDOWN * self.baseline:
+                self._decrease('slowed down')
+            elif self.limit < self.max_concurrency:
+                self.limit = min(
+                    self.max_concurrency,
+                    self.limit + 1.0 / self.limit
+                )
+                self._condition.notify_all()
+
+    def failure(self, pause=None):
+        """Records a failed request. If `pause` is given no request is
+        sent for `pause` seconds.
+        """
+        with self._condition:
+            if self.adaptive:
+                self._decrease('failed')
+            if pause:
+                self._resume_at = max(self._resume_at, time.time() + pause)
+
+    def _decrease(self, reason):
+        now = time.time()
+        # once per round trip, the requests in flight met the same trouble
+        if now - self._decreased_at < (self.latency or 0):
+            return
+        self._decreased_at = now
+        limit = max(1.0, self.limit * DECREASE)
+        if int(limit) < self.concurrency:
+            log.info(
+                'Provider %s, lowering the concurrent requests to %s'
+                % (reason, int(limit))
+            )
+        self.limit = limit
+
+
+def backoff(base, attempt, maximum):
+    """Returns the wait before the retry `attempt` (starting at 0): a
+    random time up to `base` * 2 ** `attempt`, at most `maximum`
+    seconds ("full jitter", the retries of many clients spread out).
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
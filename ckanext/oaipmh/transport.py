@@ -0,0 +1,361 @@
+"""
+HTTP transport of the OAI-PMH client.
+
+pyoai opens a new connection (urllib2) for every request. The client
+here sends its requests through one requests session per host, which
+keeps a bounded pool of connections alive and reuses them.
+
+Responses are requested compressed (gzip or deflate) and decompressed
+while they are read. The pages of the list requests are streamed, they
+are parsed while they are read from the connection. Identify and
+ListMetadataFormats responses are cached and revalidated with their
+ETag / Last-Modified.
+
+Transient failures (connection errors, timeouts, 429 and 5xx
+responses) are retried with exponential backoff, a Retry-After of the
+provider is honored. The concurrent requests to a host, of all clients
+in the process, adapt to the provider, see throttle.py.
+"""
+import email.utils
+import logging
+import sys
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import oaipmh.client
+
+import metrics
+from cache import LRUCache
+from throttle import Throttle, backoff
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1
+
+# longest wait between two attempts, in seconds
+BACKOFF_MAX = 300
+RETRY_AFTER_MAX = 3600
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# size of the chunks read from a streamed response
+CHUNK_SIZE = 64 * 1024
+
+# verbs whose responses hardly ever change
+CONDITIONAL_VERBS = ('Identify', 'ListMetadataFormats')
+
+_lock = threading.Lock()
+_sessions = {}
+_throttles = {}
+_clients = {}
+# (base url, request arguments) -> (validator headers, content)
+_conditional_cache = LRUCache(maxsize=1000)
+
+
+def get_session(url, pool_size=DEFAULT_POOL_SIZE):
+    """Returns the session of the host of `url`.
+
+    Every host has its own session with a pool of at most `pool_size`
+    connections. If all connections are in use, a request waits for
+    a free one.
+    """
+    key = _host_key(url)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = 'pyoai'
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                pool_block=True
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+    return session
+
+
+def get_throttle(url, max_concurrency=DEFAULT_POOL_SIZE, adaptive=True):
+    """Returns the throttle of the host of `url`.
+
+    Like the session, the throttle is shared by all clients of the
+    host: a failure or a Retry-After seen by one of them slows down or
+    pauses the requests of all of them. It is created with the
+    `max_concurrency` and `adaptive` of the first client.
+    """
+    key = _host_key(url)
+    with _lock:
+        throttle = _throttles.get(key)
+        if throttle is None:
+            throttle = _throttles[key] = Throttle(max_concurrency, adaptive)
+    return throttle
+
+
+def _host_key(url):
+    parts = urlparse.urlsplit(url)
+    return (parts.scheme, parts.netloc)
+
+
+def get_client(key, create_client):
+    """Returns the client cached for `key` in this process.
+
+    `create_client` is called to create the client when there is none.
+    """
+    with _lock:
+        client = _clients.get(key)
+    if client is None:
+        client = create_client()
+        with _lock:
+            client = _clients.setdefault(key, client)
+    return client
+
+
+class Client(oaipmh.client.Client):
+    """OAI-PMH client using the pooled session of its host.
+
+    `timeout` is the timeout of a request in seconds, either a number
+    or a (connect timeout, read timeout) tuple. A transient failure is
+    retried up to `max_retries` times, waiting about `backoff` seconds
+    before the first retry and twice as long before every further one.
+    At most `pool_size` requests are sent to the host at a time (by all
+    clients of the host), fewer while the provider fails or slows down
+    unless `adaptive` is False.
+
+    The bytes received (`wire_bytes`) and the bytes of the decompressed
+    responses (`decoded_bytes`) are counted, also as metrics of
+    `source_id` if it is given.
+    """
+    def __init__(self, base_url, metadata_registry=None, credentials=None,
+                 force_http_get=False, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 adaptive=True, source_id=None):
+        oaipmh.client.Client.__init__(
+            self,
+            base_url,
+            metadata_registry,
+            force_http_get=force_http_get
+        )
+        self._auth = credentials
+        self._timeout = timeout
+        self._session = get_session(base_url, pool_size)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self.throttle = get_throttle(base_url, pool_size, adaptive)
+        self.source_id = source_id
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self._bytes_lock = threading.Lock()
+
+    def makeRequest(self, **kw):
+        headers, cached = self._conditional_headers(kw)
+        response = self._request(kw, headers)
+        self._count_bytes(response)
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+        response.raise_for_status()
+        self._store_validators(kw, response)
+        return response.content
+
+    def streamRequest(self, **kw):
+        """Sends a request like makeRequest, but returns the body of the
+        response as a file object, which reads (and decompresses) it
+        from the connection. It has to be closed.
+        """
+        response = self._request(kw, {}, stream=True)
+        if response.status_code >= 400:
+            response.close()
+            response.raise_for_status()
+        return ResponseBody(self, response)
+
+    def _request(self, kw, headers, stream=False):
+        """Sends the request, retrying it on transient failures. Returns
+        the response or raises the error of the last attempt.
+        """
+        attempt = 0
+        while True:
+            response = exc_info = None
+            self.throttle.acquire()
+            start = time.time()
+            try:
+                response = self._send(kw, headers, stream)
+            except (requests.ConnectionError, requests.Timeout):
+                exc_info = sys.exc_info()
+            finally:
+                self.throttle.release()
+
+            if response is not None and \
+                    response.status_code not in RETRY_STATUS:
+                self.throttle.success(time.time() - start)
+                return response
+
+            if response is not None:
+                # give the connection back to the pool
+                response.close()
+            if attempt >= self._max_retries:
+                break
+            self._wait_for_retry(kw, attempt, response, exc_info)
+            attempt += 1
+
+        if response is None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        response.raise_for_status()
+
+    def _cache_key(self, kw):
+        if kw.get('verb') in CONDITIONAL_VERBS:
+            return (self._base_url, tuple(sorted(kw.items())))
+        return None
+
+    def _conditional_headers(self, kw):
+        """Returns the headers which revalidate the cached response of
+        the request and the cached (validators, content), or ({}, None)
+        """
+        cache_key = self._cache_key(kw)
+        cached = None
+        if cache_key is not None:
+            cached = _conditional_cache.get(cache_key)
+        if cached is None:
+            return {}, None
+        return dict(cached[0]), cached
+
+    def _store_validators(self, kw, response):
+        """Caches the response of a conditional request with its
+        validators, to revalidate it next time
+        """
+        cache_key = self._cache_key(kw)
+        if cache_key is None:
+            return
+        validators = _validators(response)
+        if validators:
+            _conditional_cache.set(cache_key, (validators, response.content))
+
+    def _wait_for_retry(self, kw, attempt, response, exc_info):
+        pause = None
+        if response is not None:
+            pause = _retry_after(response)
+        # a Retry-After pauses all requests to the provider
+        self.throttle.failure(pause)
+        wait = pause
+        if pause is None:
+            wait = backoff(self._backoff, attempt, BACKOFF_MAX)
+            time.sleep(wait)
+        log.warning(
+            '%s request to %s failed (%s), retrying in %.1fs'
+            % (
+                kw.get('verb'),
+                self._base_url,
+                exc_info[1] if response is None else response.status_code,
+                wait
+            )
+        )
+
+    def _send(self, kw, headers, stream=False):
+        if self._force_http_get:
+            return self._session.get(
+                self._base_url,
+                params=kw,
+                headers=headers,
+                auth=self._auth,
+                timeout=self._timeout,
+                stream=stream
+            )
+        return self._session.post(
+            self._base_url,
+            data=kw,
+            headers=headers,
+            auth=self._auth,
+            timeout=self._timeout,
+            stream=stream
+        )
+
+    def _count_bytes(self, response):
+        # the content is read (and decompressed) by requests, the raw
+        # response counted the bytes it read from the connection
+        decoded = len(response.content)
+        wire = response.raw.tell() if response.raw else decoded
+        self._add_bytes(wire, decoded)
+
+    def _add_bytes(self, wire, decoded):
+        with self._bytes_lock:
+            self.wire_bytes += wire
+            self.decoded_bytes += decoded
+        if self.source_id is not None:
+            metrics.count('wire_bytes', self.source_id, wire)
+            metrics.count('decoded_bytes', self.source_id, decoded)
+
+
+class ResponseBody(object):
+    """The body of a streamed response (see Client.streamRequest) as a
+    file object. The bytes are counted when it is closed.
+    """
+    def __init__(self, client, response):
+        self._client = client
+        self._response = response
+        # decompressed chunks, never much larger than the reads
+        self._chunks = response.iter_content(CHUNK_SIZE)
+        self._buffer = b''
+        self._decoded = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._decoded += len(data)
+        return data
+
+    def close(self):
+        if self._response is None:
+            return
+        response, self._response = self._response, None
+        self._client._add_bytes(response.raw.tell(), self._decoded)
+        response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _validators(response):
+    """Returns the conditional request headers to revalidate the
+    response
+    """
+    headers = {}
+    if response.headers.get('ETag'):
+        headers['If-None-Match'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        headers['If-Modified-Since'] = response.headers['Last-Modified']
+    return headers
+
+
+def _retry_after(response):
+    """Returns the seconds of the Retry-After header (a number of
+    seconds or a date) of the response, None if it has none.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = email.utils.mktime_tz(date) - time.time()
+    return min(max(seconds, 0), RETRY_AFTER_MAX)